@@ -0,0 +1,104 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Compares the ActionClassifier with the if/elif chain of substring scans it replaced, on a synthetic corpus of
+# Fidelity actions. Run with Python 2.7 or Jython 2.7 (the extension's own syntax):
+#   python2 benchmarks/bench_action_classifier.py [rows]
+
+import ast
+import os
+import random
+import re
+import sys
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source", "import_fidelity", "import_fidelity.py")
+
+def loadDefinitions(names):
+    # The script only runs inside Moneydance, so just the (pure python) definitions needed are pulled from its source
+    with open(SCRIPT) as scriptFile:
+        tree = ast.parse(scriptFile.read(), SCRIPT)
+    wanted = []
+    for node in tree.body:
+        if isinstance(node, (ast.ClassDef, ast.FunctionDef)) and node.name in names: wanted.append(node)
+        elif isinstance(node, ast.Assign) and any(getattr(target, "id", None) in names for target in node.targets): wanted.append(node)
+    namespace = {"re": re}
+    exec(compile(ast.Module(body=wanted), SCRIPT, "exec"), namespace)
+    return namespace
+
+def chainClassify(action):
+    # the original per row if/elif chain
+    buyStrings = [' BOUGHT ', 'REINVESTMENT ', 'Contributions', 'PURCHASE ']
+    buyXferStrings = [ 'TRANSFER OF ASSETS ACAT RECEIVE' ]
+    sellStrings = ['REDEMPTION ', 'SOLD ', 'IN LIEU OF FRX SHARE']
+    sellXferStrings = [ 'TRANSFER OF ASSETS ACAT DELIVER' ]
+    divStrings = ['DIVIDEND RECEIVED ', 'REGULATORY FEE ADJ']
+    divReinvestStrings = ['Dividend']
+    incStrings = ['LONG-TERM', 'SHORT-TERM']
+    miscExpStrings = ['FEE CHARGED', 'TAX PAID']
+    if any(substring in action for substring in buyStrings):
+        return "BUY"
+    elif any(substring in action for substring in buyXferStrings):
+        return "BUY_XFER"
+    elif any(substring in action for substring in sellStrings):
+        return "SELL"
+    elif any(substring in action for substring in sellXferStrings):
+        return "SELL_XFER"
+    elif any(substring in action for substring in divStrings):
+        return "DIVIDEND"
+    elif any(substring in action for substring in divReinvestStrings):
+        return "DIVIDEND_REINVEST"
+    elif any(substring in action for substring in incStrings):
+        return "MISCINC"
+    elif any(substring in action for substring in miscExpStrings):
+        return "MISCEXP"
+    return None
+
+ACTION_TEMPLATES = ["YOU BOUGHT %s (%s) (Cash)",
+                    "YOU SOLD %s (%s) (Cash)",
+                    "REINVESTMENT %s (%s) (Cash)",
+                    "DIVIDEND RECEIVED %s (%s) (Cash)",
+                    "LONG-TERM CAP GAIN %s (%s) (Cash)",
+                    "SHORT-TERM CAP GAIN %s (%s) (Cash)",
+                    "REDEMPTION PAYOUT %s (%s) (Cash)",
+                    "TRANSFER OF ASSETS ACAT RECEIVE %s (%s)",
+                    "TRANSFER OF ASSETS ACAT DELIVER %s (%s)",
+                    "FOREIGN TAX PAID %s (%s) (Cash)",
+                    "IN LIEU OF FRX SHARE %s (%s) (Cash)",
+                    "ELECTRONIC FUNDS TRANSFER RECEIVED (Cash) %s %s",
+                    "INTEREST EARNED %s (%s) (Cash)"]
+RETIREMENT_ACTIONS = ["Contributions", "Dividend", "Change in Market Value", "Exchange In", "Exchange Out", "FEE CHARGED"]
+
+def makeCorpus(rows, securities=40, seed=1):
+    rng = random.Random(seed)
+    symbols = [("SECURITY %s INC COM" %(i), "SYM%s" %(i)) for i in range(securities)]
+    distinct = [template %(name, symbol) for template in ACTION_TEMPLATES for name, symbol in symbols] + RETIREMENT_ACTIONS
+    return [rng.choice(distinct) for _i in range(rows)], len(distinct)
+
+def timeIt(classify, corpus):
+    start = time.time()
+    results = [classify(action) for action in corpus]
+    return time.time() - start, results
+
+def main(argv):
+    rows = int(argv[1]) if (len(argv) > 1) else 200000
+    definitions = loadDefinitions(["ACTION_RULES", "ActionClassifier"])
+    corpus, distinctCount = makeCorpus(rows)
+
+    chainSecs, chainResults = timeIt(chainClassify, corpus)
+    classifier = definitions["ActionClassifier"](definitions["ACTION_RULES"])
+    classifierSecs, classifierResults = timeIt(classifier.classify, corpus)
+
+    if (chainResults != classifierResults):
+        mismatches = [action for action, old, new in zip(corpus, chainResults, classifierResults) if old != new]
+        print("FAIL: classifier disagrees with the if/elif chain, e.g. '%s'" %(mismatches[0]))
+        return 1
+
+    print("%s actions (%s distinct)" %(rows, distinctCount))
+    print("if/elif chain:    %8.3fs  %10.0f rows/s" %(chainSecs, rows / max(chainSecs, 1e-9)))
+    print("ActionClassifier: %8.3fs  %10.0f rows/s  (x%.1f)" %(classifierSecs, rows / max(classifierSecs, 1e-9),
+                                                             chainSecs / max(classifierSecs, 1e-9)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
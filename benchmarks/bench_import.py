@@ -0,0 +1,157 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmarks the import on synthetic Fidelity exports (benchmarks/fidelity_csv.py) of increasing size, into an
+# in-memory book (tools/mdfake.py) already holding a share of the rows. Run with Python 2.7 or Jython 2.7:
+#   python2 benchmarks/bench_import.py [--sizes 1000,10000] [--duplicates 0.3] [--save results.json] [--compare old.json]
+#
+# Each size is imported through runHeadless() in a fresh process (so peak memory is per size). The stage timings
+# are the engine's own, from the import's run record (ImportStats) - the rows/s of a stage is the rows read over
+# its time. The model calls are made against the fake, not Moneydance - the timings are of the script's own work.
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "tools"))
+import fidelity_csv                                                                                             # noqa
+import mdfake                                                                                                   # noqa
+
+def peakMemoryKB():
+    try:
+        import resource
+    except ImportError:
+        # Jython: the JVM heap in use now (there is no high-water mark)
+        from java.lang import Runtime
+        runtime = Runtime.getRuntime()
+        return (runtime.totalMemory() - runtime.freeMemory()) // 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if (sys.platform == "darwin") else peak
+
+def makeBook(spec):
+    # The book with the spec's accounts and securities, holding the rows of the exports' history files
+    book = mdfake.FakeBook()
+    for account in fidelity_csv.makeAccounts(spec["accounts"], spec["securities"], spec["seed"]):
+        book.addInvestAccount(account.bookName(), account.number, account.securities)
+    script = mdfake.loadScript(mdfake.FakeMoneydance(book))
+    script.runHeadless(spec["histories"], spec["accountsForFiles"], forceFullCheck=1)
+    return book, script
+
+def runImport(spec):
+    book, script = makeBook(spec)
+    options = {} if (spec["watermarks"]) else {"forceFullCheck": 1}
+    start = time.time()
+    _summary, progress = script.runHeadless(spec["exports"], spec["accountsForFiles"], **options)
+    secs = time.time() - start
+    rows = progress.countRowsParsed
+    return {"rows": rows, "secs": secs, "created": progress.countCreated, "duplicates": progress.countDuplicates,
+            "peakKB": peakMemoryKB(),
+            "stages": [{"stage": stage["stage"], "secs": stage["secs"], "calls": stage["calls"], "rows": rows}
+                       for stage in progress.runRecord["stages"]]}
+
+def child(specPath, resultPath):
+    # one measurement, in its own process. The script's console output is dropped
+    with open(specPath) as specFile: spec = json.load(specFile)
+    console = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        result = runImport(spec)
+    finally:
+        sys.stdout, sys.stderr = console
+    with open(resultPath, 'w') as resultFile: json.dump(result, resultFile)
+    return 0
+
+def measure(spec, directory):
+    specPath = os.path.join(directory, "spec.json")
+    resultPath = os.path.join(directory, "result.json")
+    with open(specPath, 'w') as specFile: json.dump(spec, specFile)
+    subprocess.check_call([sys.executable, os.path.abspath(__file__), "--child", specPath, resultPath])
+    with open(resultPath) as resultFile: return json.load(resultFile)
+
+def rate(rows, secs): return rows / max(secs, 1e-9)
+
+def report(size, spec, stages, imported):
+    print("\n== %s rows (%s), %s accounts of %s securities, %.0f%% already in the book"
+          %(size, ", ".join([os.path.basename(path) for path in spec["exports"]]), spec["accounts"],
+            "/".join([str(count) for count in spec["securities"]]), spec["duplicates"] * 100))
+    total = sum([result["secs"] for result in stages["stages"]])
+    print("%-24s %9s %9s %12s %7s %10s" %("stage", "calls", "secs", "rows/s", "share", "peak KB"))
+    for result in stages["stages"]:
+        print("%-24s %9s %9.3f %12.0f %6.1f%%" %(result["stage"], result["calls"], result["secs"], rate(result["rows"], result["secs"]),
+                                                result["secs"] * 100 / max(total, 1e-9)))
+    slowest = max(stages["stages"], key=lambda result: result["secs"])
+    print("%-24s %9s %9.3f %12.0f   slowest stage: %s" %("stages total", "", total, rate(stages["rows"], total), slowest["stage"]))
+    print("%-24s %9s %9.3f %12.0f %7s %10s   created %s, duplicates %s"
+          %("import end to end", imported["rows"], imported["secs"], rate(imported["rows"], imported["secs"]), "",
+            imported["peakKB"], imported["created"], imported["duplicates"]))
+
+def compare(results, baseline, tolerance, minimumSecs=0.05):
+    # the measurements whose rows/s fell by more than tolerance against the baseline results (those shorter than
+    # minimumSecs are timer noise, and not compared)
+    regressions = []
+    for size, result in sorted(results.items()):
+        old = baseline.get(size)
+        if (old is None): continue
+        pairs = [("import end to end", old["import"], result["import"])]
+        oldStages = dict([(stage["stage"], stage) for stage in old["stages"]["stages"]])
+        pairs += [(stage["stage"], oldStages[stage["stage"]], stage) for stage in result["stages"]["stages"] if stage["stage"] in oldStages]
+        for name, before, after in pairs:
+            if (min(before["secs"], after["secs"]) < minimumSecs): continue
+            beforeRate, afterRate = rate(before["rows"], before["secs"]), rate(after["rows"], after["secs"])
+            if (afterRate < beforeRate * (1 - tolerance)):
+                regressions.append("%s rows, %s: %.0f rows/s, was %.0f" %(size, name, afterRate, beforeRate))
+    return regressions
+
+def main(argv):
+    if (len(argv) == 4 and argv[1] == "--child"): return child(argv[2], argv[3])
+
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--sizes", default="1000,10000,100000,1000000", help="total rows of each run [%default]")
+    parser.add_option("--mix", default="all=0.6,single=0.2,retirement=0.2", help="share of the rows in each dialect [%default]")
+    parser.add_option("--duplicates", type="float", default=0.3, help="share of the rows already in the book [%default]")
+    parser.add_option("--accounts", type="int", default=4, help="brokerage accounts [%default]")
+    parser.add_option("--securities", default="5,25,100", help="securities held by the accounts, in turn [%default]")
+    parser.add_option("--missing", type="float", default=0.005, help="share of the security rows naming a security not in the book [%default]")
+    parser.add_option("--watermarks", action="store_true", default=False, help="leave the import watermarks on (rows older than the book's are skipped unchecked)")
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--keep", help="write the exports to this directory and keep them")
+    parser.add_option("--save", help="save the results (json) - e.g. as the baseline of a release")
+    parser.add_option("--compare", help="results saved earlier: fail if any rows/s fell by more than --tolerance")
+    parser.add_option("--tolerance", type="float", default=0.25, help="[%default]")
+    options, _args = parser.parse_args(argv[1:])
+
+    mix = dict([(dialect, float(share)) for dialect, _equals, share in [item.partition("=") for item in options.mix.split(",")]])
+    securities = [int(count) for count in options.securities.split(",")]
+    results = {}
+    for size in [int(size) for size in options.sizes.split(",")]:
+        directory = options.keep or tempfile.mkdtemp(prefix="bench_import_")
+        if (not os.path.isdir(directory)): os.makedirs(directory)
+        try:
+            accounts = fidelity_csv.makeAccounts(options.accounts, securities, options.seed)
+            exports, histories, accountsForFiles = fidelity_csv.writeExports(directory, size, accounts, mix, options.duplicates,
+                                                                             options.missing, options.seed)
+            spec = {"exports": exports, "histories": histories, "accountsForFiles": accountsForFiles, "accounts": options.accounts,
+                    "securities": securities, "seed": options.seed, "duplicates": options.duplicates, "watermarks": options.watermarks}
+            imported = measure(spec, directory)
+            stages = {"rows": imported["rows"], "stages": imported.pop("stages")}
+        finally:
+            if (not options.keep): shutil.rmtree(directory)
+        report(size, spec, stages, imported)
+        results[str(size)] = {"stages": stages, "import": imported}
+
+    if (options.save):
+        with open(options.save, 'w') as saveFile: json.dump(results, saveFile, indent=1, sort_keys=True)
+    if (options.compare):
+        with open(options.compare) as baselineFile: regressions = compare(results, json.load(baselineFile), options.tolerance)
+        for regression in regressions: print("REGRESSION: " + regression)
+        if (regressions): return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,190 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synthetic Fidelity csv exports for the benchmarks. The rows are streamed to disk, so files of any size can be made:
+#   python2 benchmarks/fidelity_csv.py rows directory
+#
+# A set of exports is split between the three dialects the script reads (brokerage - all accounts, brokerage - single
+# account, retirement / NetBenefits). Each export also has a "history" file holding its oldest rows - imported into the
+# book first, they become the duplicates found when the export itself is imported (downloads that overlap).
+
+import csv
+import os
+import random
+import sys
+from datetime import date as Date, timedelta
+
+BOM = '\xef\xbb\xbf'
+# the disclaimer Fidelity's brokerage downloads end with, after a blank line
+FOOTER = ['"The data and information in this spreadsheet is provided to you solely for your use and is not for distribution."',
+          '"Brokerage services are provided by Fidelity Brokerage Services LLC (FBS), 900 Salem Street, Smithfield, RI 02917."',
+          '',
+          '"Date downloaded 12/31/2025 10:40 am"']
+
+BROKERAGE_COLUMNS = ['Run Date', 'Account', 'Account Number', 'Action', 'Symbol', 'Description', 'Type', 'Quantity',
+                     'Price ($)', 'Commission ($)', 'Fees ($)', 'Accrued Interest ($)', 'Amount ($)', 'Settlement Date']
+SINGLE_ACCOUNT_COLUMNS = [name for name in BROKERAGE_COLUMNS if name not in ('Account', 'Account Number')]
+RETIREMENT_COLUMNS = ['Date', 'Investment', 'Transaction Type', 'Amount', 'Shares/Unit']
+
+DIALECTS = ["all", "single", "retirement"]
+
+# (weight, action template, kind) - kind: buy / sell move shares and cash, income moves cash, cash has no security
+BROKERAGE_ACTIONS = [(30, "YOU BOUGHT %s (%s) (Cash)", "buy"),
+                     (10, "YOU SOLD %s (%s) (Cash)", "sell"),
+                     (25, "DIVIDEND RECEIVED %s (%s) (Cash)", "income"),
+                     (15, "REINVESTMENT %s (%s) (Cash)", "buy"),
+                     (5,  "LONG-TERM CAP GAIN %s (%s) (Cash)", "income"),
+                     (3,  "SHORT-TERM CAP GAIN %s (%s) (Cash)", "income"),
+                     (2,  "FOREIGN TAX PAID %s (%s) (Cash)", "income"),
+                     (10, "ELECTRONIC FUNDS TRANSFER RECEIVED (Cash)", "cash")]
+RETIREMENT_ACTIONS = [(40, "Contributions", "buy"),
+                      (20, "Dividend", "buy"),
+                      (20, "Change in Market Value", "cash"),
+                      (10, "Exchange In", "buy"),
+                      (10, "FEE CHARGED", "income")]
+
+class SyntheticAccount:
+    # An investment account of the exports: its name in the csv (the book's name is "Fidelity " + csvName), its
+    # number and its securities [(description, ticker)]
+
+    def __init__(self, csvName, number, securities, retirement=False):
+        self.csvName = csvName
+        self.number = number
+        self.securities = securities
+        self.retirement = retirement
+
+    def bookName(self): return "Fidelity " + self.csvName
+
+def makeAccounts(accountCount, securityCounts, seed=1):
+    # accountCount brokerage accounts, holding securityCounts[i % len(securityCounts)] securities each, plus a
+    # retirement account. The securities are drawn from one universe, so accounts share some
+    rng = random.Random(seed)
+    universe = [("SYNTHETIC SECURITY %s INC COM" %(i), "SY%s" %(i)) for i in range(max(securityCounts) * 2)]
+    accounts = []
+    for i in range(accountCount):
+        accounts.append(SyntheticAccount("Account %s" %(i + 1), "X%08d" %(i + 1),
+                                         rng.sample(universe, securityCounts[i % len(securityCounts)])))
+    accounts.append(SyntheticAccount("401K", "", rng.sample(universe, securityCounts[0]), retirement=True))
+    return accounts
+
+def weightedChoice(rng, choices):
+    pick = rng.uniform(0, sum([choice[0] for choice in choices]))
+    for choice in choices:
+        pick -= choice[0]
+        if (pick <= 0): return choice
+    return choices[-1]
+
+def money(value): return "%.2f" %(value)
+
+class ExportRows:
+    # Generator of one export's rows, newest first (as Fidelity lists them). A missingRatio of the security rows name a
+    # security that is not in the book
+
+    def __init__(self, dialect, rowCount, accounts, seed=1, missingRatio=0.0, days=3 * 365, lastDate=Date(2025, 12, 31)):
+        self.dialect = dialect
+        self.rowCount = rowCount
+        self.accounts = accounts
+        self.rng = random.Random(seed)
+        self.missingRatio = missingRatio
+        self.days = days
+        self.lastDate = lastDate
+
+    def header(self):
+        return {"all": BROKERAGE_COLUMNS, "single": SINGLE_ACCOUNT_COLUMNS, "retirement": RETIREMENT_COLUMNS}[self.dialect]
+
+    def security(self, account):
+        if (self.rng.random() < self.missingRatio):
+            number = self.rng.randint(1, 50)
+            return "UNLISTED SECURITY %s" %(number), "UNL%s" %(number)
+        return self.rng.choice(account.securities)
+
+    def __iter__(self):
+        rng = self.rng
+        for index in range(self.rowCount):
+            runDate = (self.lastDate - timedelta(days=(index * self.days) // max(1, self.rowCount))).strftime("%m/%d/%Y")
+            account = rng.choice(self.accounts)
+            if (self.dialect == "retirement"):
+                _weight, action, kind = weightedChoice(rng, RETIREMENT_ACTIONS)
+                description, _ticker = self.security(account)
+                amount = rng.uniform(1, 2000)
+                shares = 0.0 if (kind == "cash") else amount / rng.uniform(10, 300)
+                if (kind == "income"): amount, shares = -amount, 0.0
+                yield [runDate, description, action, money(amount), "%.3f" %(shares)]
+                continue
+
+            _weight, template, kind = weightedChoice(rng, BROKERAGE_ACTIONS)
+            price = rng.uniform(5, 500)
+            quantity = rng.randint(1, 200) + rng.choice([0, 0.5, 0.125])
+            if (kind == "cash"):
+                action, symbol, description = template, "", "No Description"
+                quantity, price, amount = "", "", money(rng.uniform(100, 5000))
+            else:
+                description, symbol = self.security(account)
+                action = template %(description, symbol)
+                if (kind == "buy"):
+                    amount = money(-quantity * price)
+                elif (kind == "sell"):
+                    amount, quantity = money(quantity * price), -quantity
+                else:
+                    amount, quantity, price = money(rng.uniform(1, 900)), 0, ""
+                price = price if (price == "") else money(price)
+            row = [runDate, action, symbol, description, "Cash", quantity, price, "", "", "", amount, runDate]
+            if (self.dialect == "all"): row[1:1] = [account.csvName, account.number]
+            yield row
+
+def writeExport(path, historyPath, rows, duplicateRatio):
+    # Writes the rows to path - the oldest duplicateRatio of them to historyPath as well. Returns the row count
+    historyFrom = rows.rowCount - int(round(rows.rowCount * duplicateRatio))
+    with open(path, 'wb') as csvFile, open(historyPath, 'wb') as historyFile:
+        writers = []
+        for outFile in (csvFile, historyFile):
+            if (rows.dialect != "retirement"): outFile.write(BOM + '\r\n')     # as Fidelity's brokerage downloads
+            writer = csv.writer(outFile)
+            writer.writerow(rows.header())
+            writers.append(writer)
+        for index, row in enumerate(rows):
+            writers[0].writerow(row)
+            if (index >= historyFrom): writers[1].writerow(row)
+        if (rows.dialect != "retirement"):
+            for outFile in (csvFile, historyFile): outFile.write('\r\n' + ''.join([line + '\r\n' for line in FOOTER]))
+    return rows.rowCount
+
+def splitRows(rowCount, mix):
+    # mix: {dialect: share} - the rows of each dialect, summing to rowCount
+    total = float(sum(mix.values()))
+    dialects = [dialect for dialect in DIALECTS if mix.get(dialect)]
+    counts = dict([(dialect, int(rowCount * mix[dialect] / total)) for dialect in dialects])
+    counts[dialects[0]] += rowCount - sum(counts.values())
+    return counts
+
+def writeExports(directory, rowCount, accounts, mix=None, duplicateRatio=0.0, missingRatio=0.0, seed=1):
+    # Writes a set of exports of rowCount rows in all. Returns (exports, histories, accountsForFiles): the csv paths
+    # to import, the paths of their history files, and the book account for each single account / retirement file
+    mix = mix or {"all": 0.6, "single": 0.2, "retirement": 0.2}
+    brokerage = [account for account in accounts if not account.retirement]
+    retirement = [account for account in accounts if account.retirement]
+    exports, histories, accountsForFiles = [], [], {}
+    for offset, (dialect, count) in enumerate(sorted(splitRows(rowCount, mix).items())):
+        dialectAccounts = {"all": brokerage, "single": brokerage[:1], "retirement": retirement}[dialect]
+        name = "fidelity_%s_%s.csv" %(dialect, rowCount)
+        path = os.path.join(directory, name)
+        historyPath = os.path.join(directory, "history_" + name)
+        writeExport(path, historyPath,
+                    ExportRows(dialect, count, dialectAccounts, seed + offset, 0.0 if (dialect == "retirement") else missingRatio),
+                    duplicateRatio)
+        exports.append(path)
+        histories.append(historyPath)
+        if (dialect != "all"):
+            accountsForFiles[name] = accountsForFiles["history_" + name] = dialectAccounts[0].bookName()
+    return exports, histories, accountsForFiles
+
+def main(argv):
+    if (len(argv) != 3):
+        print("usage: %s rows directory" %(argv[0]))
+        return 1
+    exports, _histories, _accountsForFiles = writeExports(argv[2], int(argv[1]), makeAccounts(4, [5, 25, 100]), duplicateRatio=0.3)
+    for path in exports: print(path)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -17,28 +17,55 @@ from java.lang import System
 
 
 import sys
+import os
 import traceback
+import threading
+import Queue
+import time
 import csv
+import codecs
+import itertools
+import re
 import ast
 import json
-from datetime import datetime
+import hashlib
+import heapq
+from datetime import date as Date, datetime
 
-from java.awt import FileDialog
-from javax.swing import SwingUtilities, JOptionPane
+from java.awt import FileDialog, BorderLayout
+from javax.swing import SwingUtilities, JOptionPane, JDialog, JLabel, JButton, JPanel, Timer
+from javax.swing.border import EmptyBorder
 from javax.swing.filechooser import FileFilter
-from java.io import File, FilenameFilter
+from java.io import File, FilenameFilter, IOException
+from org.python.core.util import FileUtil
 
-from com.infinitekind.moneydance.model import ParentTxn, AbstractTxn, InvestTxnType, InvestFields, AccountUtil, TxnSearch, Account, AcctFilter
+from com.infinitekind.moneydance.model import ParentTxn, AbstractTxn, InvestTxnType, InvestFields, AccountUtil, Account, AcctFilter
+from com.infinitekind.moneydance.model import AccountListener, CurrencyListener, CurrencyType
 from com.moneydance.apps.md.controller import UserPreferences
 
 if MD_REF.getBuild() >= 5100: from com.infinitekind.util import AppDebug                                                # noqa
 if MD_REF.getBuild() >= 4097: from com.infinitekind.util import DateUtil
+HAS_UNIQUE_TIME = MD_REF.getBuild() >= 4097
 
 # NOTE - only put variables here that do not lock on to MD internals.. Ideally move all inside doMain()
 useStuartsKey = 0
 
+FIID = 'script:import_fidelity.py'
+PROTOCOL_ID = 101           # txnKey() digest
+JSON_PROTOCOL_ID = 100      # legacy: json of the full csv row
+OLD_PROTOCOL_ID = 99        # legacy: python repr of the full csv row
+
 class QuickAbortThisScriptException(Exception): pass      # This is a way to quickly exit the script
 
+# Set whilst an import (or undo) runs - a JVM wide system property, as Moneydance reloads the script on each invocation
+IMPORT_RUNNING_PROPERTY = "import_fidelity.running"
+
+def claimImportRun():
+    # True if no other import is running - this one then holds the claim until releaseImportRun()
+    return System.getProperties().putIfAbsent(IMPORT_RUNNING_PROPERTY, datetime.now().strftime("%Y-%m-%d %H:%M:%S")) is None
+
+def releaseImportRun(): System.clearProperty(IMPORT_RUNNING_PROPERTY)
+
 #####################################################
 class FileExtensionFilter(FileFilter, FilenameFilter):
 
@@ -72,29 +99,552 @@ class FileExtensionFilter(FileFilter, FilenameFilter):
     def getDescription(self): return "Import Files"
 #####################################################
 
-def txnKey(row):
+# The dialects of the Fidelity exports name the same columns differently - fold them together for keying
+CANONICAL_COLUMN_NAMES = {'Run Date': 'Date',
+                          'Amount ($)': 'Amount',
+                          'Transaction Type': 'Action',
+                          'Shares/Unit': 'Quantity',
+                          'Investment': 'Description'}
+STUARTS_KEY_COLUMNS = ['Date', 'Account', 'Action', 'Amount', 'Symbol', 'Quantity']
+
+def normalizeRow(row):
+    normalized = {}
+    for name, value in row.items():
+        # None holds surplus fields (stored as "null" once through json); 'Unique' was the old tie-breaker
+        if name is None or name == 'null' or name == 'Unique': continue
+        if isinstance(value, list): value = ','.join(value)
+        name = name.strip()
+        normalized[CANONICAL_COLUMN_NAMES.get(name, name)] = (value or '').strip()
+    return normalized
+
+# Where each field is found in the dialects of the Fidelity exports - the first of its columns in the header is used
+FIELD_COLUMNS = [("date",          ['Run Date', 'Date']),
+                 ("action",        ['Action', 'Transaction Type']),
+                 ("amount",        ['Amount', 'Amount ($)']),
+                 ("quantity",      ['Quantity', 'Shares/Unit']),
+                 ("description",   ['Description', 'Investment']),
+                 ("symbol",        ['Symbol']),
+                 ("account",       ['Account']),
+                 ("accountNumber", ['Account Number'])]
+REQUIRED_FIELDS = ["date", "action", "amount", "quantity", "description"]
+
+# The known export layouts (name, identifying columns) - first match names the file's dialect
+CSV_DIALECTS = [("Fidelity brokerage - all accounts",   ['Run Date', 'Account', 'Action', 'Symbol', 'Amount ($)']),
+                ("Fidelity brokerage - single account", ['Run Date', 'Action', 'Symbol', 'Amount ($)']),
+                ("Fidelity retirement / NetBenefits",   ['Date', 'Investment', 'Transaction Type', 'Shares/Unit'])]
+
+class CsvSchemaError(Exception): pass
+
+#####################################################
+class CsvSchema:
+    # Compiled once per file from its header row: the column index of each field, so that the rows are read as plain
+    # lists without probing the column names on every row. Raises CsvSchemaError for a header lacking a required field
+
+    def __init__(self, header):
+        self.header = [(name or '').strip() for name in header]
+        self.columns = {}
+        for field, names in FIELD_COLUMNS:
+            for name in names:
+                if name in self.header:
+                    self.columns[field] = self.header.index(name)
+                    break
+
+        missing = [field for field in REQUIRED_FIELDS if field not in self.columns]
+        if (missing):
+            raise CsvSchemaError("Unrecognised csv layout - missing column(s): %s. Header found: %s"
+                                 %(", ".join([" or ".join(names) for field, names in FIELD_COLUMNS if field in missing]),
+                                   ", ".join(self.header)))
+
+        self.dialect = "Fidelity - other layout"
+        for dialect, dialectColumns in CSV_DIALECTS:
+            if all([name in self.header for name in dialectColumns]):
+                self.dialect = dialect
+                break
+
+        # the txnKey() names of the columns, None for those left out of the key (as normalizeRow())
+        self.keyNames = [None if (name == 'Unique') else CANONICAL_COLUMN_NAMES.get(name, name) for name in self.header]
+
+    def has(self, field): return field in self.columns
+
+    def get(self, row, field):
+        # the (raw) value - '' when the layout has no such column or the row is short
+        index = self.columns.get(field)
+        if (index is None or index >= len(row)): return ''
+        return row[index]
+
+    def normalize(self, row):
+        # as normalizeRow() of the row read as a dict. Surplus fields are ignored, missing ones are ''
+        normalized = {}
+        rowLength = len(row)
+        for index, name in enumerate(self.keyNames):
+            if (name is None): continue
+            normalized[name] = row[index].strip() if (index < rowLength) else ''
+        return normalized
+
+    def describe(self, row):
+        return dict(zip(self.header, row))
+#####################################################
+
+def txnKeyText(normalizedRow):
     if (useStuartsKey):
-        if 'Amount' in row:
-            rowAmount = row['Amount']
-        elif 'Amount ($)' in row:
-            rowAmount = row['Amount ($)']
-        else:
-            rowAmount = "?"
-        
-        key = "%s|%s|%s|%s|%s|%s|%s" % (
-            row.get('Run Date') or row.get('Date'),
-            row.get('Account',''),
-            row.get('Action',''),
-            rowAmount,
-            row.get('Symbol',''),
-            row.get('Quantity',''),
-            row.get('Unique',''))
-        return key
+        text = '|'.join([normalizedRow.get(column, '') for column in STUARTS_KEY_COLUMNS])
     else:
-        return json.dumps(row, sort_keys=True, separators=(',', ':'))
+        text = json.dumps(normalizedRow, sort_keys=True, separators=(',', ':'))
+    if isinstance(text, unicode): text = text.encode('utf-8')
+    return text
+
+def digestKey(keyText, occurrence=0):
+    if (occurrence): keyText += '#%s' %(occurrence)
+    return hashlib.sha1(keyText).hexdigest()
+
+def txnKey(normalizedRow, occurrence=0):
+    # fixed width digest of the normalized row. occurrence numbers identical rows within the same file
+    return digestKey(txnKeyText(normalizedRow), occurrence)
+
+def importableRows(rows, schema):
+    # Generator: drops the rows without an action (blank lines, Fidelity's disclaimer footer...)
+    for row in rows:
+        if (not schema.get(row, "action")): continue
+        yield row
+
+def keyRows(rows, schema, importFile=None):
+    # Generator: yields (txnKey, row). Identical rows within the file are numbered so that re-imports produce the same
+    # keys - only an occurrence count per distinct key is held between rows, never the rows themselves. The numbered
+    # rows are counted in importFile.countRepeated, the rows keyed and the time spent keying them in countKeyed / keySecs
+    occurrences = {}
+    for row in rows:
+        start = time.time()
+        keyText = txnKeyText(schema.normalize(row))
+        rowKey = digestKey(keyText)
+        occurrence = occurrences.get(rowKey, 0)
+        occurrences[rowKey] = occurrence + 1
+        if (occurrence):
+            rowKey = digestKey(keyText, occurrence)
+            if (importFile): importFile.countRepeated += 1
+        if (importFile):
+            importFile.countKeyed += 1
+            importFile.keySecs += time.time() - start
+        yield rowKey, row
+
+# The byte order marks an export may start with (Excel's "Unicode text" is utf-16), and the delimiters it may use
+BYTE_ORDER_MARKS = [('\xef\xbb\xbf', 'utf-8'), ('\xff\xfe', 'utf-16-le'), ('\xfe\xff', 'utf-16-be')]
+CSV_DELIMITERS = [',', '\t', ';', '|']
+HEADER_COLUMN_NAMES = set([name for _field, names in FIELD_COLUMNS for name in names])
+
+def isBlankRow(row):
+    for value in row:
+        if (value.strip()): return False
+    return True
+
+def countRowValues(row):
+    return len([value for value in row if value.strip()])
+
+#####################################################
+class CsvReader:
+    # Buffered reader of an export, CHUNK_SIZE bytes at a time. detect() works out, once, from the file's first
+    # SAMPLE_SIZE bytes: the encoding (byte order mark, else utf-8 if the sample is valid utf-8, else cp1252), the
+    # delimiter and the header - the first row naming at least two known columns, which may follow a preamble
+    # (else the first non-blank row, which CsvSchema will reject). Text that is not utf-8 is transcoded as it is read,
+    # so the rows are always utf-8 byte strings (as the csv module needs), keyed the same as those of a utf-8 file.
+    # batches() hands on the rows after the header a list at a time, without the footer: a trailing block of single
+    # value rows after a blank row (Fidelity's disclaimer) is held back and dropped, never reaching the import.
+    # bytesRead is how far into the file the reader has got
+
+    CHUNK_SIZE = 256 * 1024
+    SAMPLE_SIZE = 64 * 1024
+    BATCH_SIZE = 500
+
+    def __init__(self, path, chunkSize=None):
+        self.path = path
+        self.chunkSize = chunkSize or self.CHUNK_SIZE
+        self.size = None
+        self.encoding = None
+        self.bomLength = 0
+        self.delimiter = None
+        self.header = None
+        self.bytesRead = 0
+        self.countFooterRows = 0
+
+    def detect(self):
+        # returns the header row. Raises CsvSchemaError if the file has none
+        self.size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as inFile:
+            sample = inFile.read(self.SAMPLE_SIZE)
+
+        self.encoding = None
+        for bom, encoding in BYTE_ORDER_MARKS:
+            if (sample.startswith(bom)):
+                self.encoding, self.bomLength = encoding, len(bom)
+                break
+        if (self.encoding is None):
+            try:
+                codecs.getincrementaldecoder('utf-8')().decode(sample)
+                self.encoding = 'utf-8'
+            except UnicodeDecodeError:
+                self.encoding = 'cp1252'
+
+        lines = self.transcode(sample[self.bomLength:], codecs.getincrementaldecoder(self.encoding)('replace'),
+                               len(sample) >= self.size).splitlines()
+        if (len(sample) < self.size and len(lines) > 1): lines.pop()           # cut part way through
+
+        firstRow = None
+        for line in lines:
+            if (not line.strip()): continue
+            for delimiter in CSV_DELIMITERS:
+                row = next(csv.reader([line], delimiter=delimiter))
+                if (len([value for value in row if value.strip() in HEADER_COLUMN_NAMES]) >= 2):
+                    self.delimiter, self.header = delimiter, row
+                    return row
+            if (firstRow is None): firstRow = line
+        if (firstRow is None): raise CsvSchemaError("No header row found")
+
+        self.delimiter = max(CSV_DELIMITERS, key=lambda delimiter: firstRow.count(delimiter))
+        self.header = next(csv.reader([firstRow], delimiter=self.delimiter))
+        return self.header
+
+    def transcode(self, data, decoder, final=False):
+        if (self.encoding == 'utf-8'): return data
+        return decoder.decode(data, final).encode('utf-8')
+
+    def chunkLines(self, inFile):
+        # Generator: lists of the file's lines (with their line ends), a chunk at a time. A chunk's last line is only
+        # handed on once its line end has been read
+        decoder = codecs.getincrementaldecoder(self.encoding)('replace')
+        inFile.seek(self.bomLength)
+        self.bytesRead = self.bomLength
+        tail = ''
+        while True:
+            chunk = inFile.read(self.chunkSize)
+            self.bytesRead += len(chunk)
+            text = tail + self.transcode(chunk, decoder, not chunk)
+            if (not chunk):
+                if (text): yield [text]
+                return
+            if (not text): continue
+            lines = text.splitlines(True)
+            tail = '' if (lines[-1].endswith('\n')) else lines.pop()
+            yield lines
+
+    def batches(self, batchSize=None):
+        # Generator: lists of about batchSize rows (lists), those after the header - the footer left out
+        batchSize = batchSize or self.BATCH_SIZE
+        if (self.header is None): self.detect()
+        self.countFooterRows = 0
+        with open(self.path, 'rb') as inFile:
+            rows = csv.reader(itertools.chain.from_iterable(self.chunkLines(inFile)), delimiter=self.delimiter)
+            for row in rows:
+                if (row == self.header): break
+
+            batch = []
+            held = None                 # the rows from a blank row on - the footer, unless a row of values follows
+            for row in rows:
+                if (held is None):
+                    if (row and (row[0] or not isBlankRow(row))):
+                        batch.append(row)
+                        if (len(batch) >= batchSize):
+                            yield batch
+                            batch = []
+                    else:
+                        held = [row]
+                elif (countRowValues(row) < 2):
+                    held.append(row)
+                else:
+                    batch.extend(held)
+                    batch.append(row)
+                    held = None
+
+            if (held): self.countFooterRows = len([row for row in held if not isBlankRow(row)])
+            if (batch): yield batch
+#####################################################
+
+#####################################################
+class ImportFile:
+    # A csv file being imported, with its own layout and date format (detected per file), the account picked for it
+    # when the csv has no account column, and its counts for the summary
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.schema = None
+        self.dateConverter = DateConverter()
+        self.acctContext = None
+        self.countCreated = 0
+        self.countDuplicates = 0
+        self.countOlder = 0             # rows dated before the account's watermark
+        self.countSkipped = 0           # rows not imported because of an error
+        self.countRepeated = 0          # rows identical to an earlier row of the file (numbered, so still imported)
+        self.countPlanned = 0           # txns the plan will create
+        self.acctIDs = set()            # the accounts of the rows planned (created or found to be duplicates)
+        self.countKeyed = 0             # rows keyed (keyRows())
+        self.keySecs = 0.0              # of which time spent keying
+        self.parseSecs = 0.0            # batch mode: time taken by parse()
+        self.stuartsKeyCounts = {}      # (account uuid, stuartsLegacyKey()) - rows seen, numbering identical ones
+        self.reader = CsvReader(path)
+
+    def isStuartsKeyInBook(self, txnIdIndex, account, row):
+        # True if the row was imported under its legacy stuartsLegacyKey() fiTxnId (see FiTxnIdIndex.containsStuartsKey())
+        key = stuartsLegacyKey(self.schema, row)
+        countKey = (account.getUUID(), key)
+        occurrence = self.stuartsKeyCounts.get(countKey, 0)
+        self.stuartsKeyCounts[countKey] = occurrence + 1
+        return txnIdIndex.containsStuartsKey(account, key, occurrence)
+
+    def readHeader(self):
+        # detects the file's encoding / delimiter / header and compiles its CsvSchema - raises CsvSchemaError for a
+        # file that is not a known layout
+        self.schema = CsvSchema(self.reader.detect())
+
+    def readBatches(self, batchSize=None):
+        # Generator: the rows (lists) following the header, a list at a time - without the footer
+        return self.reader.batches(batchSize)
+
+    def readRows(self):
+        # Generator: the rows (lists) following the header
+        for batch in self.readBatches():
+            for row in batch: yield row
+
+    def filteredRows(self, progress, skipRow=None, rowIndexes=None):
+        # Generator: the importable rows - streamed, so only the current batch of rows is held. Rows for which
+        # skipRow(importFile, row) is true are dropped. The index (among all the importable rows) of each row handed
+        # on is appended to rowIndexes, if given
+        rows = importableRows(progress.countBatches(self.reader, self.readBatches()), self.schema)
+        for rowIndex, row in enumerate(rows):
+            if (skipRow and skipRow(self, row)): continue
+            if (rowIndexes is not None): rowIndexes.append(rowIndex)
+            yield row
+
+    def keyedRows(self, progress, online, skipRow=None, rowIndexes=None):
+        # Generator: (fiTxnId, row) for the importable rows (see filteredRows())
+        rows = self.filteredRows(progress, skipRow, rowIndexes)
+        if (online): return keyRows(rows, self.schema, self)
+        return ((None, row) for row in rows)
+
+    def parse(self, progress, online, skipRow=None):
+        # Batch mode: the keys of the rows to import and their indexes among the importable rows - [(fiTxnId, rowIndex)].
+        # Only these are held, not the rows: the rows to plan are read again once merged (rereadImportFiles())
+        start = time.time()
+        rowIndexes = []
+        keys = [fiTxnId for fiTxnId, _row in self.keyedRows(progress, online, skipRow, rowIndexes)]
+        self.parseSecs = time.time() - start
+        return zip(keys, rowIndexes)
+#####################################################
+
+def mergeImportFiles(importFiles, parsedFiles):
+    # Merges the parsed files' keys (ImportFile.parse()) - returns the rows of each file to plan, {rowIndex: fiTxnId}.
+    # A key already seen in an earlier file (within the same account) is the same txn downloaded twice - it is
+    # dropped and counted as a duplicate of the later file
+    keptRows = []
+    seenKeys = set()
+    for importFile, parsed in zip(importFiles, parsedFiles):
+        scope = importFile.acctContext.account.getUUID() if (importFile.acctContext) else None
+        kept = {}
+        for fiTxnId, rowIndex in parsed:
+            if (fiTxnId is not None):
+                if ((scope, fiTxnId) in seenKeys):
+                    importFile.countDuplicates += 1
+                    continue
+                seenKeys.add((scope, fiTxnId))
+            kept[rowIndex] = fiTxnId
+        keptRows.append(kept)
+    return keptRows
+
+def rereadImportFiles(importFiles, keptRows):
+    # Generator: (importFile, fiTxnId, row) of the rows kept by mergeImportFiles() - the files read again, one by one
+    for importFile, kept in zip(importFiles, keptRows):
+        remaining = len(kept)
+        if (not remaining): continue
+        for rowIndex, row in enumerate(importableRows(importFile.readRows(), importFile.schema)):
+            if (rowIndex not in kept): continue
+            yield importFile, kept[rowIndex], row
+            remaining -= 1
+            if (not remaining): break
+
+def parallelMap(func, items, threadCount, isCancelled=None):
+    # Returns [func(item) for item in items], run on up to threadCount threads (Jython has no GIL, so they really do
+    # run in parallel). If any call raises, the first exception is re-raised once all the threads have finished. Once
+    # isCancelled() is true no more items are started (their results are left None)
+    results = [None] * len(items)
+    failures = []
+    pending = Queue.Queue()
+    for index in range(len(items)): pending.put(index)
+
+    def worker():
+        while (not failures and not (isCancelled and isCancelled())):
+            try:
+                index = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(items[index])
+            except:
+                failures.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker, name="import_fidelity_parser_%s" %(threadNumber))
+               for threadNumber in range(max(1, min(threadCount, len(items))))]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    if (failures): raise failures[0][0], failures[0][1], failures[0][2]
+    return results
+
+def parseLegacyTxnKey(legacyId):
+    # Returns (normalizedRow, tieBreaker) for a json fiTxnId, None if not understood
+    try:
+        row = json.loads(legacyId)
+    except ValueError:
+        row = None
+    if isinstance(row, dict):
+        return normalizeRow(row), row.get('Unique')
+    return None
+
+def splitStuartsLegacyKey(legacyId):
+    # Returns (stuartsLegacyKey(), tieBreaker) for a Stuart's '|' separated fiTxnId, None if it is not one
+    if (legacyId.count('|') != len(STUARTS_KEY_COLUMNS)): return None
+    key, _bar, tieBreaker = legacyId.rpartition('|')
+    return key, (tieBreaker or None)
+
+def stuartsLegacyKey(schema, row):
+    # The '|' separated fiTxnId the script stored with useStuartsKey before the digests, without its 'Unique'
+    # tie-breaker - built as it was: from the untrimmed values of the literal column names, the row read as
+    # csv.DictReader did (None for a short row's missing values). Its columns cannot be recovered from the stored
+    # string (e.g. a retirement row's 'Transaction Type' was not its 'Action'), so rows are matched by rebuilding it
+    values = dict(zip(schema.header, row))
+    for name in schema.header[len(row):]: values[name] = None
+    if ('Amount' in values):
+        amount = values['Amount']
+    elif ('Amount ($)' in values):
+        amount = values['Amount ($)']
+    else:
+        amount = "?"
+    return "%s|%s|%s|%s|%s|%s" %(values.get('Run Date') or values.get('Date'), values.get('Account', ''),
+                                 values.get('Action', ''), amount, values.get('Symbol', ''), values.get('Quantity', ''))
+
+def legacyReprToJson(oldTxnId):
+    # the json fiTxnId of a legacy python repr one. Raises ValueError / SyntaxError if it is not a literal
+    return json.dumps(ast.literal_eval(oldTxnId), sort_keys=True, separators=(',', ':'))
+
+def legacyTxnKeys(legacyIds):
+    # Maps legacy (full row) fiTxnIds to their txnKey() digest, so txns imported before the digests still match.
+    # legacyIds is a list of (legacyId, value). Identical rows were told apart by a 'Unique' timestamp - ordering
+    # on it reproduces the occurrence counter. Returns ({digest: value}, {stuartsLegacyKey: [value by occurrence]}) -
+    # Stuart's ids (with useStuartsKey) are kept as they are, for rows to be matched against
+    byKey = {}
+    stuartsKeys = {}
+    for legacyId, value in legacyIds:
+        stuartsKey = splitStuartsLegacyKey(legacyId) if (useStuartsKey) else None
+        if (stuartsKey is not None):
+            key, tieBreaker = stuartsKey
+            stuartsKeys.setdefault(key, []).append((tieBreaker is not None, tieBreaker, value))
+            continue
+        parsed = parseLegacyTxnKey(legacyId)
+        if (parsed is None):
+            myPrint("WARN: unable to interpret legacy fiTxnId '%s' - ignored" %(legacyId))
+            continue
+        normalizedRow, tieBreaker = parsed
+        byKey.setdefault(txnKey(normalizedRow), []).append((tieBreaker is not None, tieBreaker, normalizedRow, value))
+
+    digests = {}
+    for key, entries in byKey.items():
+        entries.sort(key=lambda entry: entry[:2])
+        for occurrence, (_hasTieBreaker, _tieBreaker, normalizedRow, value) in enumerate(entries):
+            digests[key if occurrence == 0 else txnKey(normalizedRow, occurrence)] = value
+    for key, entries in stuartsKeys.items():
+        entries.sort(key=lambda entry: entry[:2])
+        stuartsKeys[key] = [value for _hasTieBreaker, _tieBreaker, value in entries]
+    return digests, stuartsKeys
+
+# Fidelity action wordings (substrings of the csv 'Action' / 'Transaction Type') by InvestTxnType name.
+# Rules are tried in this order - the first rule with a matching substring wins. Add new wordings here
+ACTION_RULES = [("BUY",               [' BOUGHT ', 'REINVESTMENT ', 'Contributions', 'PURCHASE ']),
+                ("BUY_XFER",          ['TRANSFER OF ASSETS ACAT RECEIVE']),
+                ("SELL",              ['REDEMPTION ', 'SOLD ', 'IN LIEU OF FRX SHARE']),
+                ("SELL_XFER",         ['TRANSFER OF ASSETS ACAT DELIVER']),
+                ("DIVIDEND",          ['DIVIDEND RECEIVED ', 'REGULATORY FEE ADJ']),
+                ("DIVIDEND_REINVEST", ['Dividend']),
+                ("MISCINC",           ['LONG-TERM', 'SHORT-TERM']),
+                ("MISCEXP",           ['FEE CHARGED', 'TAX PAID'])]
+
+#####################################################
+class ActionClassifier:
+    # Maps an action string to the value of the first rule holding one of its substrings (None if no rule matches).
+    # rules is a list of (value, [substrings]). The rules are compiled into one regex - an alternation of
+    # lookaheads, one per rule, so rule order (not the position of the match in the action) still decides.
+    # Results are cached by exact action string as the exports repeat the same few dozen actions throughout
+
+    def __init__(self, rules):
+        self.values = []
+        branches = []
+        for value, substrings in rules:
+            if (not substrings): continue
+            self.values.append(value)
+            branches.append("(?=.*?(%s))" %("|".join([re.escape(substring) for substring in substrings])))
+        self.pattern = re.compile("^(?:%s)" %("|".join(branches)), re.DOTALL) if (branches) else None
+        self.cache = {}
+        self.countHits = 0
+
+    def classify(self, action):
+        try:
+            value = self.cache[action]
+            self.countHits += 1
+            return value
+        except KeyError:
+            pass
+        match = self.pattern.match(action) if (self.pattern) else None
+        value = self.values[match.lastindex - 1] if (match) else None
+        self.cache[action] = value
+        return value
+#####################################################
+
+# Date layouts seen in the Fidelity exports: (name, pattern, group numbers of year / month / day)
+DATE_FORMATS = [("MM/DD/YYYY", re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})$"), (3, 1, 2)),
+                ("MM/DD/YY",   re.compile(r"(\d{1,2})/(\d{1,2})/(\d{2})$"), (3, 1, 2)),
+                ("YYYY-MM-DD", re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})$"), (1, 2, 3))]
+
+#####################################################
+class DateConverter:
+    # Converts the csv date strings straight to Moneydance date ints (YYYYMMDD), memoized per distinct string - an
+    # export repeats a few hundred dates across thousands of rows. The format that matches is then tried first, so
+    # the file's format is detected by the first date and the others are only tried for odd rows. A trailing note
+    # ("01/02/2024 as of 12/31/2023") is dropped. Returns None for a string that is not a date
+
+    def __init__(self):
+        self.formats = list(DATE_FORMATS)
+        self.cache = {}
+        self.countHits = 0
+
+    def detectedFormat(self): return self.formats[0][0]
+
+    def toDateInt(self, dateString):
+        try:
+            dateInt = self.cache[dateString]
+            self.countHits += 1
+            return dateInt
+        except KeyError:
+            pass
+        dateInt = self.parse(dateString)
+        self.cache[dateString] = dateInt
+        return dateInt
+
+    def parse(self, dateString):
+        text = dateString.strip()
+        asOf = text.lower().find(" as of ")
+        if (asOf >= 0): text = text[:asOf].rstrip()
+
+        for position, (_name, pattern, groups) in enumerate(self.formats):
+            match = pattern.match(text)
+            if (not match): continue
+            year, month, day = [int(match.group(group)) for group in groups]
+            if (year < 100): year += 2000 if (year < 69) else 1900         # as strptime's %y
+            try:
+                Date(year, month, day)
+            except ValueError:
+                return None
+            if (position): self.formats.insert(0, self.formats.pop(position))
+            return year * 10000 + month * 100 + day
+        return None
+#####################################################
 
 def uniqueTime():
-    if MD_REF.getBuild() >= 4097:
+    if HAS_UNIQUE_TIME:
         return DateUtil.getUniqueCurrentTimeMillis()
     else:
         return System.currentTimeMillis()
@@ -109,14 +659,1220 @@ def parseAmount(s):
     if not s: return 0.0
     return float(s)
 
-def getSecurityAcct(investAcct, securityName, tickerSymbol):
-    for secAcct in investAcct.getSubAccounts():
-        if secAcct.getAccountType() != Account.AccountType.SECURITY: continue
-        if securityName and secAcct.getCurrencyType().getName() == securityName:
-            return secAcct
-        if tickerSymbol and secAcct.getCurrencyType().getTickerSymbol().strip().lower() == tickerSymbol.strip().lower():
-            return secAcct
-    return None
+def loadStoredJson(book, fileName):
+    # Reads a json document saved (encrypted) inside the dataset's local storage - None if missing / unreadable
+    try:
+        inStream = book.getLocalStorage().openFileForReading(fileName)
+    except IOException:
+        return None
+    if (inStream is None): return None
+
+    inFile = FileUtil.wrap(inStream)
+    try:
+        return json.load(inFile)
+    except ValueError:
+        myPrint("WARN: ignoring unreadable stored data: '%s'" %(fileName))
+        return None
+    finally:
+        inFile.close()
+
+def saveStoredJson(book, fileName, data):
+    outFile = FileUtil.wrap(book.getLocalStorage().openFileForWriting(fileName))
+    try:
+        outFile.write(json.dumps(data, separators=(',', ':')))
+    finally:
+        outFile.close()
+
+#####################################################
+class FiTxnIdIndex:
+    # Persistent index of the fiTxnIds already imported by this script, scoped by investment account (and date).
+    # Stored in the dataset's local storage as: {account uuid: {"txnCount": n, "ids": {fiTxnId: [date, txn uuid]}}}
+    # Txns carrying a legacy (full row json) id are indexed under the equivalent txnKey() digest; Stuart's '|' ids
+    # (useStuartsKey) under "stuartsKeys": {stuartsLegacyKey(): [[date, txn uuid] by occurrence]}, matched row by row.
+    # An account's entry is trusted whilst the account's txn count matches the count recorded when last saved,
+    # otherwise just that account's txns are rescanned (never the whole book). Hits are confirmed by txn uuid.
+    # Whilst the LegacyTxnIdMigration is pending, reprProtocolId's (python repr) ids are read as their json would be.
+
+    STORAGE_FILENAME = "import_fidelity_fitxnid_index.json"
+    VERSION = 4
+
+    def __init__(self, book, fiid, protocolId, legacyProtocolId, reprProtocolId=None):
+        self.book = book
+        self.txnSet = book.getTransactionSet()
+        self.fiid = fiid
+        self.protocolId = protocolId
+        self.legacyProtocolId = legacyProtocolId
+        self.reprProtocolId = reprProtocolId
+        self.accounts = {}
+        self.checkedAccounts = {}
+        self.dirty = False
+        self.countRebuilt = 0
+
+        data = loadStoredJson(book, self.STORAGE_FILENAME)
+        if (data and data.get("version") == self.VERSION and data.get("fiid") == fiid and data.get("protocol") == protocolId
+                and data.get("stuartsKey") == useStuartsKey):
+            self.accounts = data.get("accounts", {})
+
+    def getAccountIds(self, account):
+        acctID = account.getUUID()
+        if (acctID not in self.checkedAccounts):
+            acctTxns = self.txnSet.getTransactionsForAccount(account)
+            entry = self.accounts.get(acctID)
+            if (entry is None or entry.get("txnCount") != acctTxns.getSize()):
+                myPrint("Rebuilding fiTxnId index for account: '%s'" %(account.getAccountName()))
+                entry = self.rebuildAccount(acctTxns)
+                self.accounts[acctID] = entry
+                self.countRebuilt += 1
+                self.dirty = True
+            self.checkedAccounts[acctID] = account
+        return self.accounts[acctID]["ids"]
+
+    def getAccountStuartsKeys(self, account):
+        # {stuartsLegacyKey(): [[date, txn uuid] by occurrence]} of the account's txns imported with useStuartsKey
+        self.getAccountIds(account)
+        return self.accounts[account.getUUID()].get("stuartsKeys", {})
+
+    def rebuildAccount(self, acctTxns):
+        ids = {}
+        legacyIds = []
+        for txn in acctTxns:
+            if not isinstance(txn, ParentTxn): continue
+            if (txn.getFIID() != self.fiid): continue                                                               # another importer's txn
+            fiTxnId = txn.getFiTxnId(self.protocolId)
+            if (fiTxnId):
+                ids[fiTxnId] = [txn.getDateInt(), txn.getUUID()]
+            else:
+                legacyId = txn.getFiTxnId(self.legacyProtocolId)
+                if (not legacyId and self.reprProtocolId is not None): legacyId = self.reprAsJson(txn)
+                if (legacyId): legacyIds.append((legacyId, [txn.getDateInt(), txn.getUUID()]))
+
+        # digests of the legacy ids are only worked out here - i.e. for the accounts being imported into
+        stuartsKeys = {}
+        if (legacyIds):
+            digests, stuartsKeys = legacyTxnKeys(legacyIds)
+            ids.update(digests)
+
+        # txnCount is stamped on save, once this session's new txns have been synced
+        return {"txnCount": None, "ids": ids, "stuartsKeys": stuartsKeys}
+
+    def reprAsJson(self, txn):
+        reprId = txn.getFiTxnId(self.reprProtocolId)
+        if (not reprId): return None
+        try:
+            return legacyReprToJson(reprId)
+        except (ValueError, SyntaxError):
+            return None
+
+    def contains(self, account, fiTxnId):
+        ids = self.getAccountIds(account)
+        entry = ids.get(fiTxnId)
+        if (entry is None): return False
+        if (self.txnSet.getTxnByID(entry[1]) is None):
+            # txn deleted since it was indexed
+            del ids[fiTxnId]
+            self.dirty = True
+            return False
+        return True
+
+    def containsStuartsKey(self, account, stuartsKey, occurrence):
+        # as contains(), for a row's stuartsLegacyKey() - the occurrence'th row with that key in its file
+        entries = self.getAccountStuartsKeys(account).get(stuartsKey)
+        if (not entries or occurrence >= len(entries)): return False
+        return self.txnSet.getTxnByID(entries[occurrence][1]) is not None
+
+    def isUnchanged(self, account):
+        # True if the account's txn count is the one recorded when the index was last saved - i.e. no txns were added
+        # or deleted outside the import since
+        entry = self.accounts.get(account.getUUID())
+        return (entry is not None and entry.get("txnCount") == self.txnSet.getTransactionsForAccount(account).getSize())
+
+    def invalidateAccount(self, acctID):
+        # forces a rescan of the account on next use
+        if (self.accounts.pop(acctID, None) is not None): self.dirty = True
+        self.checkedAccounts.pop(acctID, None)
+
+    def add(self, account, pTxn, fiTxnId, date):
+        self.getAccountIds(account)[fiTxnId] = [date, pTxn.getUUID()]
+        self.dirty = True
+
+    def discard(self, account, fiTxnId):
+        # the txn is being deleted - call before deleting, so that the account's entry is checked against its old count
+        if (self.getAccountIds(account).pop(fiTxnId, None) is not None): self.dirty = True
+
+    def save(self):
+        if (not self.dirty): return
+        for acctID, account in self.checkedAccounts.items():
+            self.accounts[acctID]["txnCount"] = self.txnSet.getTransactionsForAccount(account).getSize()
+        saveStoredJson(self.book, self.STORAGE_FILENAME, {"version": self.VERSION,
+                                                          "fiid": self.fiid,
+                                                          "protocol": self.protocolId,
+                                                          "stuartsKey": useStuartsKey,
+                                                          "accounts": self.accounts})
+        self.dirty = False
+#####################################################
+
+#####################################################
+class LegacyTxnIdMigration:
+    # One-shot conversion of legacy fiTxnIds (python dict repr under oldProtocolId) to json ids under protocolId.
+    # The legacy txns are found once and their uuids saved (PENDING_FILENAME), then converted in batches with the
+    # position reached checkpointed to local storage after each batch - so an interrupted migration resumes where it
+    # stopped. Txns whose ids could not be converted are kept and retried by the next import; only once none remain
+    # is the migration marked complete, after which imports skip the legacy check entirely.
+
+    STORAGE_FILENAME = "import_fidelity_migration.json"
+    PENDING_FILENAME = "import_fidelity_migration_pending.json"
+    BATCH_SIZE = 500
+
+    def __init__(self, book, protocolId, oldProtocolId):
+        self.book = book
+        self.txnSet = book.getTransactionSet()
+        self.protocolId = protocolId
+        self.oldProtocolId = oldProtocolId
+        self.countMigrated = 0
+        self.countFailed = 0
+
+        self.state = loadStoredJson(book, self.STORAGE_FILENAME)
+        if (not self.state or self.state.get("from") != oldProtocolId or self.state.get("to") != protocolId
+                or ("position" not in self.state and not self.state.get("complete"))):
+            self.state = {"from": oldProtocolId, "to": protocolId, "complete": False, "position": None, "failed": []}
+
+    def isComplete(self): return self.state["complete"]
+
+    def saveState(self):
+        saveStoredJson(self.book, self.STORAGE_FILENAME, self.state)
+
+    def migrateTxn(self, txn):
+        oldTxnId = txn.getFiTxnId(self.oldProtocolId)
+        if (not oldTxnId): return False
+        try:
+            newTxnId = legacyReprToJson(oldTxnId)
+        except (ValueError, SyntaxError) as e:
+            myPrint("ERROR: unable to convert legacy fiTxnId '%s' (%s) - left unchanged" %(oldTxnId, e))
+            return False
+
+        txn.setEditingMode()
+        txn.setFiTxnId(self.protocolId, newTxnId)
+        txn.setFiTxnId(self.oldProtocolId, None)
+        txn.syncItem()
+        return True
+
+    def run(self):
+        # returns the uuids of the accounts holding migrated txns
+        touchedAccounts = set()
+        if (self.isComplete()): return touchedAccounts
+
+        position = self.state["position"]
+        pending = None if (position is None) else loadStoredJson(self.book, self.PENDING_FILENAME)
+        if (pending is None):
+            # first run (or the previous run left failures to retry): the list is saved once, only the position after
+            pending = self.state["failed"] or [txn.getUUID() for txn in self.txnSet.iterableTxns()
+                                               if isinstance(txn, ParentTxn) and txn.getFiTxnId(self.oldProtocolId)]
+            saveStoredJson(self.book, self.PENDING_FILENAME, pending)
+            position = 0
+            self.state["failed"] = []
+            myPrint("Found %s legacy fiTxnIds to migrate" %(len(pending)))
+        else:
+            myPrint("Resuming migration of %s legacy fiTxnIds" %(len(pending) - position))
+
+        while (position < len(pending)):
+            self.state["position"] = position
+            self.saveState()
+            for txnID in pending[position:position + self.BATCH_SIZE]:
+                txn = self.txnSet.getTxnByID(txnID)
+                if (txn is None): continue
+                if (self.migrateTxn(txn)):
+                    self.countMigrated += 1
+                    touchedAccounts.add(txn.getAccount().getUUID())
+                elif (txn.getFiTxnId(self.oldProtocolId)):
+                    self.state["failed"].append(txnID)
+            position += self.BATCH_SIZE
+
+        self.countFailed = len(self.state["failed"])
+        self.state["position"] = None
+        self.state["complete"] = (self.countFailed == 0)
+        self.saveState()
+        saveStoredJson(self.book, self.PENDING_FILENAME, [])
+        if (self.countFailed):
+            myPrint("Migrated %s legacy fiTxnIds - %s could not be converted (retried by the next import)" %(self.countMigrated, self.countFailed))
+        else:
+            myPrint("Migrated %s legacy fiTxnIds" %(self.countMigrated))
+        return touchedAccounts
+#####################################################
+
+def securityNameKey(name):
+    # security names (and tickers) are matched case-insensitively, runs of spaces as one - csv rows and the book differ
+    return ' '.join((name or '').split()).lower()
+
+#####################################################
+class SecurityLookup(AccountListener, CurrencyListener):
+    # Index of each investment account's security sub-accounts by (lowercase) security name and ticker, built
+    # the first time the account is looked up and reused for every row. The earliest sub-account matching on either
+    # the name or the ticker wins - as when the sub-accounts were scanned in turn. Whilst listening, an account's
+    # index is dropped when a sub-account is added / changed under it, and all indexes when a currency changes
+    # (e.g. a security renamed)
+
+    def __init__(self, book):
+        self.book = book
+        self.indexes = {}
+        self.listening = False
+        self.countLookups = 0
+        self.countIndexBuilds = 0
+
+    def startListening(self):
+        self.book.addAccountListener(self)
+        self.book.getCurrencies().addCurrencyListener(self)
+        self.listening = True
+
+    def stopListening(self):
+        if (not self.listening): return
+        self.book.removeAccountListener(self)
+        self.book.getCurrencies().removeCurrencyListener(self)
+        self.listening = False
+
+    def invalidate(self, investAcct=None):
+        if (investAcct is None):
+            self.indexes = {}
+        else:
+            self.indexes.pop(investAcct.getUUID(), None)
+
+    # AccountListener
+    def accountAdded(self, parentAcct, newAcct): self.invalidate(parentAcct)
+    def accountDeleted(self, parentAcct, deletedAcct): self.invalidate(parentAcct)
+    def accountModified(self, acct):
+        if (acct.getAccountType() == Account.AccountType.SECURITY): self.invalidate(acct.getParentAccount())
+    def accountBalanceChanged(self, acct): pass
+
+    # CurrencyListener
+    def currencyTableModified(self, currencyTable): self.invalidate()
+
+    def buildIndex(self, investAcct):
+        byName = {}
+        byTicker = {}
+        for position, secAcct in enumerate(investAcct.getSubAccounts()):
+            if secAcct.getAccountType() != Account.AccountType.SECURITY: continue
+            security = secAcct.getCurrencyType()
+            if (security is None): continue
+            name = securityNameKey(security.getName())
+            if (name): byName.setdefault(name, (position, secAcct))
+            ticker = securityNameKey(security.getTickerSymbol())
+            if (ticker): byTicker.setdefault(ticker, (position, secAcct))
+        return byName, byTicker
+
+    def getSecurityAcct(self, investAcct, securityName, tickerSymbol):
+        self.countLookups += 1
+        acctID = investAcct.getUUID()
+        index = self.indexes.get(acctID)
+        if (index is None):
+            index = self.buildIndex(investAcct)
+            self.indexes[acctID] = index
+            self.countIndexBuilds += 1
+        byName, byTicker = index
+
+        matches = []
+        name = securityNameKey(securityName)
+        if (name in byName): matches.append(byName[name])
+        ticker = securityNameKey(tickerSymbol)
+        if (ticker in byTicker): matches.append(byTicker[ticker])
+        if (not matches): return None
+        return min(matches, key=lambda match: match[0])[1]
+#####################################################
+
+#####################################################
+class MissingSecurity:
+    # A security the csv names that its investment account does not hold - securityAccount is set once it is added
+
+    def __init__(self, account, name, tickerSymbol):
+        self.account = account
+        self.name = name
+        self.tickerSymbol = tickerSymbol
+        self.securityAccount = None
+#####################################################
+
+#####################################################
+class MissingSecurities:
+    # The distinct securities missing from each investment account, collected over every row of the plan and then
+    # added in one pass - before any txn is built - by create(). Each is linked to the existing security (currency
+    # type) with the same ticker, else the same name, found through an index of the book's securities built once;
+    # otherwise a new security is created. A security the account already holds reuses its sub-account. Keyed by
+    # (account uuid, lowercase ticker - or name when there is none)
+
+    DECIMAL_PLACES = 4
+
+    def __init__(self, book):
+        self.book = book
+        self.missing = {}
+        self.order = []
+        self.countLinked = 0
+        self.countCreated = 0
+        self.countReused = 0            # linked to the account's existing sub-account - none added
+
+    def add(self, account, securityName, tickerSymbol):
+        # returns (the MissingSecurity, True if first seen) - None if the row names no security at all
+        securityName = (securityName or '').strip()
+        tickerSymbol = (tickerSymbol or '').strip()
+        if (not securityName and not tickerSymbol): return None, False
+        key = (account.getUUID(), securityNameKey(tickerSymbol) or securityNameKey(securityName))
+        missing = self.missing.get(key)
+        if (missing is not None): return missing, False
+        missing = MissingSecurity(account, securityName or tickerSymbol, tickerSymbol)
+        self.missing[key] = missing
+        self.order.append(missing)
+        return missing, True
+
+    def __len__(self): return len(self.order)
+
+    def buildIndex(self):
+        byTicker = {}
+        byName = {}
+        for security in self.book.getCurrencies().getAllCurrencies():
+            if (security.getCurrencyType() != CurrencyType.Type.SECURITY): continue
+            ticker = securityNameKey(security.getTickerSymbol())
+            if (ticker): byTicker.setdefault(ticker, security)
+            name = securityNameKey(security.getName())
+            if (name): byName.setdefault(name, security)
+        return byTicker, byName
+
+    @staticmethod
+    def findSecurityAcct(investAcct, security):
+        # the account's existing sub-account for the security, else None
+        for secAcct in investAcct.getSubAccounts():
+            if (secAcct.getAccountType() == Account.AccountType.SECURITY and secAcct.getCurrencyType() == security): return secAcct
+        return None
+
+    def makeSecurity(self, name, tickerSymbol):
+        security = CurrencyType(self.book.getCurrencies())
+        security.setEditingMode()
+        security.setName(name)
+        security.setTickerSymbol(tickerSymbol)
+        security.setIDString(tickerSymbol or name)
+        security.setCurrencyType(CurrencyType.Type.SECURITY)
+        security.setDecimalPlaces(self.DECIMAL_PLACES)
+        security.setRelativeRate(1.0)
+        security.syncItem()
+        return security
+
+    def create(self):
+        byTicker, byName = self.buildIndex()
+        for missing in self.order:
+            ticker = securityNameKey(missing.tickerSymbol)
+            name = securityNameKey(missing.name)
+            security = (byTicker.get(ticker) if (ticker) else None) or byName.get(name)
+            if (security is None):
+                security = self.makeSecurity(missing.name, missing.tickerSymbol)
+                if (ticker): byTicker[ticker] = security
+                byName[name] = security
+                self.countCreated += 1
+                myPrint("Created security: '%s' '%s'" %(missing.name, missing.tickerSymbol))
+            else:
+                self.countLinked += 1
+                # the account may hold it already, under a name the row did not match (or via another missing entry)
+                secAcct = self.findSecurityAcct(missing.account, security)
+                if (secAcct is not None):
+                    missing.securityAccount = secAcct
+                    self.countReused += 1
+                    continue
+
+            secAcct = Account.makeAccount(self.book, Account.AccountType.SECURITY, missing.account)
+            secAcct.setCurrencyType(security)
+            secAcct.setAccountName(security.getName())
+            secAcct.syncItem()
+            missing.securityAccount = secAcct
+            myPrint("Added security '%s' to invest account '%s'" %(security.getName(), missing.account.getAccountName()))
+#####################################################
+
+#####################################################
+class AccountContext:
+    # An investment account with the defaults every txn created in it needs - worked out once per account per run
+
+    def __init__(self, account, build):
+        self.account = account
+        self.acctID = account.getUUID()
+        self.xfrAcct = AccountUtil.getDefaultTransferAcct(account)
+        self.category = AccountUtil.getDefaultCategoryForAcct(account)
+        self.hasFeeCategory = build >= 5202
+        if (self.hasFeeCategory):
+            self.feeAcct = AccountUtil.getDefaultFeeCategoryForAcct(account)                                   # noqa
+        else:
+            self.feeAcct = self.category
+#####################################################
+
+#####################################################
+class AccountResolver:
+    # Resolves the csv's 'Account' / 'Account Number' to an AccountContext. Tries accountNamePrefix + name, then
+    # name, then number. Results are cached by the raw (name, number) pair - failures too. lookup() returns the
+    # context (None if not found). resolve() returns (context, None), or (None, errorText) the first time a pair
+    # fails and (None, None) thereafter - so each missing account is reported once
+
+    def __init__(self, investAccountsByName, investAccountsByNumber, accountNamePrefix, build):
+        self.investAccountsByName = investAccountsByName
+        self.investAccountsByNumber = investAccountsByNumber
+        self.accountNamePrefix = accountNamePrefix
+        self.build = build
+        self.resolved = {}
+        self.countHits = 0
+        self.contexts = {}
+        self.reported = set()
+
+    def contextFor(self, account):
+        acctID = account.getUUID()
+        context = self.contexts.get(acctID)
+        if (context is None):
+            context = AccountContext(account, self.build)
+            self.contexts[acctID] = context
+        return context
+
+    def normalizedNames(self, accountName, accountNumber):
+        return ((self.accountNamePrefix + accountName).strip().lower(),
+                accountName.strip().lower(),
+                (accountNumber or '').strip().lower())
+
+    def lookup(self, accountName, accountNumber):
+        key = (accountName, accountNumber)
+        try:
+            context = self.resolved[key]
+            self.countHits += 1
+            return context
+        except KeyError:
+            pass
+
+        accountName1, accountName2, accountNumber = self.normalizedNames(accountName, accountNumber)
+        account = (self.investAccountsByName.get(accountName1)
+                   or self.investAccountsByName.get(accountName2)
+                   or (self.investAccountsByNumber.get(accountNumber) if (accountNumber) else None))
+
+        context = self.contextFor(account) if (account) else None
+        self.resolved[key] = context
+        return context
+
+    def resolve(self, accountName, accountNumber):
+        context = self.lookup(accountName, accountNumber)
+        if (context is not None): return context, None
+
+        key = (accountName, accountNumber)
+        if (key in self.reported): return None, None
+        self.reported.add(key)
+        return None, "ERROR: account: '%s' AND '%s' with number '%s' NOT found" %self.normalizedNames(accountName, accountNumber)
+#####################################################
+
+#####################################################
+class ImportWatermarks:
+    # Per investment account: the latest txn date imported (created, or found to be already there) and the keys of
+    # the txns imported on that date. Rows dated before an account's watermark are dropped before they are keyed, and
+    # rows on the watermark date with a known key are duplicates. Also holds the sha1 fingerprints of the files that
+    # have been fully imported (only hashing a file when one of the same size has been seen), with the accounts its
+    # rows were for and the ImportBatches batch that created its txns. Stored as:
+    # {"accounts": {account uuid: {"date": date, "keys": [fiTxnId...]}},
+    #  "files": {sha1: {"size": n, "name": ..., "imported": ..., "accounts": [account uuid...], "batch": batch id}}}
+
+    STORAGE_FILENAME = "import_fidelity_watermarks.json"
+    VERSION = 1
+    FINGERPRINT_BLOCK = 1024 * 1024
+
+    def __init__(self, book, fiid, protocolId):
+        self.book = book
+        self.fiid = fiid
+        self.protocolId = protocolId
+        self.accounts = {}
+        self.files = {}
+        self.seen = {}                  # this run's {account uuid: [latest date, set(keys on that date)]}
+
+        data = loadStoredJson(book, self.STORAGE_FILENAME)
+        if (data and data.get("version") == self.VERSION and data.get("fiid") == fiid and data.get("protocol") == protocolId
+                and data.get("stuartsKey") == useStuartsKey):
+            for acctID, mark in data.get("accounts", {}).items():
+                self.accounts[acctID] = [mark["date"], set(mark["keys"])]
+            self.files = data.get("files", {})
+
+    def isBefore(self, acctID, date):
+        mark = self.accounts.get(acctID)
+        return (mark is not None and date is not None and date < mark[0])
+
+    def isBoundaryDuplicate(self, acctID, date, fiTxnId):
+        mark = self.accounts.get(acctID)
+        return (mark is not None and date == mark[0] and fiTxnId in mark[1])
+
+    def record(self, acctID, date, fiTxnId):
+        # a txn now in the book - the new watermarks only take effect once committed
+        mark = self.seen.get(acctID)
+        if (mark is None or date > mark[0]):
+            self.seen[acctID] = [date, set([fiTxnId])]
+        elif (date == mark[0]):
+            mark[1].add(fiTxnId)
+
+    def commit(self):
+        for acctID, (date, keys) in self.seen.items():
+            mark = self.accounts.get(acctID)
+            if (mark is None or date > mark[0]):
+                self.accounts[acctID] = [date, keys]
+            elif (date == mark[0]):
+                mark[1].update(keys)
+        self.seen = {}
+
+    @staticmethod
+    def fingerprint(path):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as inFile:
+            while True:
+                block = inFile.read(ImportWatermarks.FINGERPRINT_BLOCK)
+                if (not block): break
+                digest.update(block)
+        return digest.hexdigest()
+
+    def findImportedFile(self, path):
+        # (fingerprint, stored details) of an identical file already fully imported, else None
+        size = os.path.getsize(path)
+        if (not [entry for entry in self.files.values() if entry["size"] == size]): return None
+        fingerprint = self.fingerprint(path)
+        importedFile = self.files.get(fingerprint)
+        return (fingerprint, importedFile) if (importedFile) else None
+
+    def addImportedFile(self, path, name, acctIDs, batchId):
+        # returns the file's fingerprint
+        fingerprint = self.fingerprint(path)
+        self.files[fingerprint] = {"size": os.path.getsize(path), "name": name,
+                                   "imported": datetime.now().strftime("%Y-%m-%d %H:%M"),
+                                   "accounts": sorted(acctIDs), "batch": batchId}
+        return fingerprint
+
+    def forgetAccount(self, acctID):
+        # txns have been removed from the account - its next import checks every row again. True if it had a watermark
+        return self.accounts.pop(acctID, None) is not None
+
+    def forgetFile(self, fingerprint):
+        self.files.pop(fingerprint, None)
+
+    def save(self):
+        saveStoredJson(self.book, self.STORAGE_FILENAME, {"version": self.VERSION,
+                                                          "fiid": self.fiid,
+                                                          "protocol": self.protocolId,
+                                                          "stuartsKey": useStuartsKey,
+                                                          "accounts": dict([(acctID, {"date": date, "keys": sorted(keys)})
+                                                                            for acctID, (date, keys) in self.accounts.items()]),
+                                                          "files": self.files})
+#####################################################
+
+#####################################################
+class ImportBatches:
+    # The import runs (batches) that can be undone. Each run's txns carry its batch id (txn parameter TXN_PARAMETER) and
+    # are listed in the batch's manifest - {account uuid: [[txn uuid, fiTxnId]...]} - so undoing a batch deletes just
+    # its txns without searching the book. The latest MAX_BATCHES batches are kept, their manifests in numbered slots
+    # (reused in turn) of the dataset's local storage. Stored as:
+    # {"sequence": n, "batches": [{"id", "slot", "started", "files", "count", "accounts", "fingerprints", "undone"}]}
+
+    STORAGE_FILENAME = "import_fidelity_batches.json"
+    MANIFEST_FILENAME = "import_fidelity_batch_%s.json"
+    TXN_PARAMETER = "import_fidelity.batch"
+    MAX_BATCHES = 20
+    VERSION = 1
+
+    def __init__(self, book):
+        self.book = book
+        self.sequence = 0
+        self.batches = []
+        self.manifests = {}             # {batch id: manifest} loaded
+
+        data = loadStoredJson(book, self.STORAGE_FILENAME)
+        if (data and data.get("version") == self.VERSION):
+            self.sequence = data.get("sequence", 0)
+            self.batches = data.get("batches", [])
+
+    def newBatch(self, fileNames):
+        # a batch for a new import run - only stored once saveBatch() is called
+        self.sequence += 1
+        now = datetime.now()
+        return {"id": "%s-%s" %(now.strftime("%Y%m%d-%H%M%S"), self.sequence),
+                "slot": self.sequence % self.MAX_BATCHES,
+                "started": now.strftime("%Y-%m-%d %H:%M:%S"),
+                "files": list(fileNames),
+                "count": 0,
+                "accounts": [],
+                "fingerprints": [],
+                "undone": None}
+
+    def saveBatch(self, batch, manifest):
+        batch["count"] = sum([len(txns) for txns in manifest.values()])
+        batch["accounts"] = sorted(manifest.keys())
+        saveStoredJson(self.book, self.MANIFEST_FILENAME %(batch["slot"]), {"id": batch["id"], "txns": manifest})
+        # the batch whose slot is reused can no longer be undone
+        self.batches = [other for other in self.batches if other["slot"] != batch["slot"] and other["id"] != batch["id"]]
+        self.batches.append(batch)
+        self.save()
+
+    def loadManifest(self, batch):
+        if (batch["id"] in self.manifests): return self.manifests[batch["id"]]
+        data = loadStoredJson(self.book, self.MANIFEST_FILENAME %(batch["slot"]))
+        manifest = data["txns"] if (data and data.get("id") == batch["id"]) else None
+        self.manifests[batch["id"]] = manifest
+        return manifest
+
+    def isInBook(self, batchId, acctIDs):
+        # True if the batch (not undone) created txns in the accounts, and every one of them is still in the book
+        batch = self.find(batchId) if (batchId) else None
+        if (batch is None or batch["undone"]): return False
+        manifest = self.loadManifest(batch)
+        if (manifest is None): return False
+        txnSet = self.book.getTransactionSet()
+        found = False
+        for acctID in acctIDs:
+            for txnID, _fiTxnId in manifest.get(acctID, []):
+                if (txnSet.getTxnByID(txnID) is None): return False
+                found = True
+        return found
+
+    def find(self, batchRef):
+        # batchRef: a batch id, or "last" for the latest batch not yet undone - None if there is no such batch
+        if (batchRef == "last"):
+            candidates = [batch for batch in self.batches if not batch["undone"]]
+        else:
+            candidates = [batch for batch in self.batches if batch["id"] == batchRef]
+        return candidates[-1] if (candidates) else None
+
+    def markUndone(self, batch):
+        batch["undone"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.save()
+
+    def describe(self):
+        return "\n".join(["%s: %s txns from %s%s" %(batch["id"], batch["count"], ", ".join(batch["files"]),
+                                                     " (undone %s)" %(batch["undone"]) if (batch["undone"]) else "")
+                          for batch in reversed(self.batches)])
+
+    def save(self):
+        saveStoredJson(self.book, self.STORAGE_FILENAME, {"version": self.VERSION,
+                                                          "sequence": self.sequence,
+                                                          "batches": self.batches})
+#####################################################
+
+#####################################################
+class TxnCommitBatch:
+    # Holds built (not yet synced) ParentTxns and syncs them a chunk at a time, with balance recalculation and UI
+    # refresh (via ui, an ImportUI) suspended until the chunk completes. If a sync fails part way through a chunk, the
+    # txns already synced from that chunk are deleted again before the error is re-raised. onCommitted(pTxn, *details)
+    # is called for each txn once its whole chunk has been synced
+
+    def __init__(self, book, ui, chunkSize, onCommitted=None):
+        self.book = book
+        self.ui = ui
+        self.chunkSize = max(1, chunkSize)
+        self.onCommitted = onCommitted
+        self.pending = []
+        self.countSynced = 0
+        self.countChunks = 0
+        self.countRolledBack = 0
+
+    def add(self, pTxn, *details):
+        self.pending.append((pTxn, details))
+        if (len(self.pending) >= self.chunkSize): self.flush()
+
+    def flush(self):
+        if (not self.pending): return
+        chunk = self.pending
+        self.pending = []
+
+        synced = []
+        self.ui.setSuspendRefresh(True)
+        self.book.setRecalcBalances(False)
+        try:
+            for pTxn, details in chunk:
+                pTxn.syncItem()
+                synced.append(pTxn)
+        except:
+            myPrint("ERROR: commit failed - rolling back the %s txns already synced from this batch" %(len(synced)))
+            for pTxn in reversed(synced): pTxn.deleteItem()
+            self.countRolledBack += len(synced)
+            raise
+        finally:
+            self.book.setRecalcBalances(True)
+            self.ui.setSuspendRefresh(False)
+        self.countSynced += len(synced)
+        self.countChunks += 1
+
+        if (self.onCommitted):
+            for pTxn, details in chunk: self.onCommitted(pTxn, *details)
+#####################################################
+
+def runOnEDT(func, *args):
+    # Runs func(*args) on the Swing EDT and waits for it - returns its result (or re-raises its exception)
+    if SwingUtilities.isEventDispatchThread(): return func(*args)
+    outcome = []
+    def runner():
+        try:
+            outcome.append((True, func(*args)))
+        except:
+            outcome.append((False, sys.exc_info()))
+    SwingUtilities.invokeAndWait(runner)
+    ok, value = outcome[0]
+    if (not ok): raise value[0], value[1], value[2]
+    return value
+
+IMPORT_FILE_EXTENSIONS = ["csv", "tsv", "txt"]
+
+def chooseImportFiles(mdGUI, strings, importDirKey):
+    # Returns ([Files selected], directory) - several files may be selected
+    fwin = mdGUI.getFileChooser(None, strings.choose_import_file + " (CSV, TSV, TXT)", FileDialog.LOAD,
+                          FileExtensionFilter(IMPORT_FILE_EXTENSIONS), [importDirKey, UserPreferences.IMPORT_DIR, UserPreferences.DATA_DIR])
+    if hasattr(fwin, "setMultipleMode"): fwin.setMultipleMode(True)
+    fwin.setVisible(True)
+    if hasattr(fwin, "getFiles"): return list(fwin.getFiles()), fwin.getDirectory()
+    if (fwin.getFile() is None or fwin.getDirectory() is None): return [], None
+    return [File(fwin.getDirectory(), fwin.getFile())], fwin.getDirectory()
+
+def selectInvestAccountName(investAccountNames, fileName):
+    return JOptionPane.showInputDialog(
+        None,
+        "Select the investment account for '%s':" %(fileName),
+        "Investment Account Selection Dialog",
+        JOptionPane.QUESTION_MESSAGE,
+        None,
+        investAccountNames,
+        investAccountNames[0])
+
+#####################################################
+class ImportProgress:
+    # Counters shared between the import worker thread(s) and the progress dialog on the EDT
+
+    def __init__(self):
+        self.startTime = time.time()
+        self.countRowsParsed = 0
+        self.bytesRead = 0
+        self.bytesTotal = 0                 # the size of the files being read
+        self.countDuplicates = 0
+        self.countCreated = 0
+        self.cancelled = False
+        self.lock = threading.Lock()        # batch mode parses the files on several threads
+        self.plan = None                    # the ImportPlan, once planned
+        self.runRecord = None               # ImportStats.record() of the finished import
+        self.batchId = None                 # the ImportBatches id of the txns created, once applied
+
+    def cancel(self): self.cancelled = True
+
+    def isCancelled(self): return self.cancelled
+
+    def countBatches(self, reader, batches):
+        # Generator: the rows of the batches (from reader, a CsvReader) - counted, with the bytes read, a batch at a time
+        offset = 0
+        for batch in batches:
+            if (self.cancelled): return                                                                            # stop reading
+            with self.lock:
+                self.countRowsParsed += len(batch)
+                self.bytesRead += reader.bytesRead - offset
+            offset = reader.bytesRead
+            for row in batch: yield row
+        with self.lock: self.bytesRead += reader.bytesRead - offset
+
+    def describe(self):
+        elapsed = max(time.time() - self.startTime, 0.001)
+        reading = ""
+        if (self.bytesTotal and self.bytesRead < self.bytesTotal):
+            reading = "Read: %.1f of %.1f MB (%.0f%%)" %(self.bytesRead / 1048576.0, self.bytesTotal / 1048576.0, self.bytesRead * 100.0 / self.bytesTotal)
+            if (self.bytesRead): reading += ", about %.0fs left" %(elapsed * (self.bytesTotal - self.bytesRead) / self.bytesRead)
+            reading += "<br>"
+        return ("<html>%sRows parsed: %s<br>Duplicates found: %s<br>Transactions created: %s (%.1f per second)</html>"
+                %(reading, self.countRowsParsed, self.countDuplicates, self.countCreated, self.countCreated / elapsed))
+#####################################################
+
+#####################################################
+class ImportStats:
+    # Where an import's time goes: seconds and calls per stage, counters, and the slowest rows. The row loop takes its
+    # rows through timedRows(), which times fetching each row (reading / keying it when streamed) and closes the
+    # previous row - so the loop's early continues need no bookkeeping. The loop calls lap() as each stage ends. A row
+    # planned as a txn is held (holdRow()) until applyPlan()'s loop carries on timing it, so its time includes building
+    # and committing the txn. With debug each row's stage timings are printed as it completes. record() returns the run
+    # record (a dict, for json)
+
+    SLOWEST_ROWS = 10
+
+    def __init__(self, debug=0):
+        self.debug = debug
+        self.startTime = time.time()
+        self.lastLap = self.startTime
+        self.stages = []                    # stage names, in the order first timed
+        self.stageSecs = {}
+        self.stageCalls = {}
+        self.counters = {}
+        self.slowest = []                   # heap of (secs, rowNumber, (importFile, fiTxnId, row), laps)
+        self.rowNumber = 0
+        self.rowItem = None
+        self.rowStart = None
+        self.rowLaps = None
+
+    def lap(self, stage, since):
+        # adds the time since `since` to stage - returns now, i.e. the start of the next stage
+        now = time.time()
+        secs = now - since
+        if (stage not in self.stageSecs):
+            self.stages.append(stage)
+            self.stageSecs[stage] = 0.0
+            self.stageCalls[stage] = 0
+        self.stageSecs[stage] += secs
+        self.stageCalls[stage] += 1
+        if (self.rowLaps is not None): self.rowLaps.append((stage, secs))
+        self.lastLap = now
+        return now
+
+    def count(self, counter, increment=1):
+        self.counters[counter] = self.counters.get(counter, 0) + increment
+
+    def moveSecs(self, fromStage, toStage, secs, calls):
+        # splits secs (timed by a part of its work, e.g. a generator stage) out of fromStage into toStage
+        if (fromStage not in self.stageSecs): return
+        secs = min(secs, self.stageSecs[fromStage])
+        self.stageSecs[fromStage] -= secs
+        if (toStage not in self.stageSecs):
+            self.stages.insert(self.stages.index(fromStage) + 1, toStage)
+            self.stageSecs[toStage] = 0.0
+            self.stageCalls[toStage] = 0
+        self.stageSecs[toStage] += secs
+        self.stageCalls[toStage] += calls
+
+    def timedRows(self, stage, rows, heldRow=None):
+        # Generator: the rows, the fetch of each timed under stage. The loop's time on a row ends when it asks for the
+        # next. With heldRow(item) - the holdRow() of the item's row - each row carries on from where it was held
+        rows = iter(rows)
+        while True:
+            start = time.time()
+            self.endRow(start)
+            try:
+                item = next(rows)
+            except StopIteration:
+                return
+            if (heldRow):
+                self.rowNumber, secs, self.rowLaps, self.rowItem = heldRow(item)
+                self.rowStart = start - secs
+            else:
+                self.rowNumber += 1
+                self.rowItem = item
+                self.rowStart = start
+                self.rowLaps = [] if (self.debug) else None
+            self.lap(stage, start)
+            yield item
+
+    def holdRow(self):
+        # Takes the current row out of the timings until timedRows(heldRow=) carries on with it. Returns its (row number,
+        # secs so far, laps, (importFile, fiTxnId, row)) - the row itself only with debug, so the plan holds no rows
+        importFile, fiTxnId, row = self.rowItem
+        held = (self.rowNumber, time.time() - self.rowStart, self.rowLaps, (importFile, fiTxnId, row if (self.debug) else None))
+        self.rowItem = None
+        self.rowLaps = None
+        return held
+
+    def endHeldRows(self, heldRows):
+        # the rows held but never carried on with (a dry run, the plan declined or cancelled) - their time is the planning's
+        for heldRow in heldRows:
+            if (heldRow is None): continue
+            rowNumber, secs, laps, rowItem = heldRow
+            self.rankRow(secs, rowNumber, rowItem, laps)
+
+    def endRow(self, now):
+        if (self.rowItem is None): return
+        self.rankRow(now - self.rowStart, self.rowNumber, self.rowItem, self.rowLaps)
+        self.rowItem = None
+        self.rowLaps = None
+
+    def rankRow(self, secs, rowNumber, rowItem, laps):
+        entry = (secs, rowNumber, rowItem, laps)
+        if (len(self.slowest) < self.SLOWEST_ROWS):
+            heapq.heappush(self.slowest, entry)
+        elif (secs > self.slowest[0][0]):
+            heapq.heapreplace(self.slowest, entry)
+        if (self.debug):
+            myPrint("row %s: %.3fms (%s)" %(rowNumber, secs * 1000,
+                                            ", ".join(["%s %.3fms" %(stage, stageSecs * 1000) for stage, stageSecs in laps])))
+
+    def record(self, progress, importFiles, options):
+        self.endRow(time.time())
+        secs = max(time.time() - self.startTime, 0.001)
+        slowestRows = []
+        for rowSecs, rowNumber, (importFile, fiTxnId, row), laps in sorted(self.slowest, reverse=True):
+            slowestRow = {"row": rowNumber, "file": importFile.name, "secs": round(rowSecs, 6), "fiTxnId": fiTxnId}
+            if (self.debug):
+                # the row's csv values (account numbers etc) only go into the console / run history when debugging
+                slowestRow["values"] = importFile.schema.describe(row)
+                slowestRow["stages"] = dict([(stage, round(stageSecs, 6)) for stage, stageSecs in laps])
+            slowestRows.append(slowestRow)
+
+        return {"version": 1,
+                "started": datetime.fromtimestamp(self.startTime).strftime("%Y-%m-%d %H:%M:%S"),
+                "secs": round(secs, 3),
+                "rowsRead": progress.countRowsParsed,
+                "rowsPerSecond": round(progress.countRowsParsed / secs, 1),
+                "created": progress.countCreated,
+                "duplicates": progress.countDuplicates,
+                "cancelled": progress.isCancelled(),
+                "batch": progress.batchId,
+                "options": dict(options.__dict__),
+                "files": [{"name": importFile.name,
+                           "dialect": importFile.schema.dialect if (importFile.schema) else None,
+                           "dateFormat": importFile.dateConverter.detectedFormat(),
+                           "encoding": importFile.reader.encoding,
+                           "delimiter": importFile.reader.delimiter,
+                           "footerRows": importFile.reader.countFooterRows,
+                           "created": importFile.countCreated,
+                           "duplicates": importFile.countDuplicates,
+                           "older": importFile.countOlder,
+                           "skipped": importFile.countSkipped,
+                           "repeated": importFile.countRepeated} for importFile in importFiles],
+                "stages": [{"stage": stage,
+                            "secs": round(self.stageSecs[stage], 4),
+                            "calls": self.stageCalls[stage],
+                            "share": round(self.stageSecs[stage] * 100 / secs, 1)} for stage in self.stages],
+                "counters": dict(self.counters),
+                "slowestRows": slowestRows}
+
+    @staticmethod
+    def describe(record):
+        # the run record's timings, as a table for the console
+        lines = ["Import took %.3fs - %s rows read (%.0f per second)" %(record["secs"], record["rowsRead"], record["rowsPerSecond"])]
+        lines += ["  %-28s %9.4fs %5.1f%% %9s calls" %(stage["stage"], stage["secs"], stage["share"], stage["calls"]) for stage in record["stages"]]
+        lines += ["  %-28s %10s" %(counter, value) for counter, value in sorted(record["counters"].items())]
+        lines += ["  slowest row %s of '%s': %.3fms" %(row["row"], row["file"], row["secs"] * 1000) for row in record["slowestRows"][:3]]
+        return "\n".join(lines)
+#####################################################
+
+def appendRunRecord(path, record):
+    # one json line per run - the import's latency can be tracked over time
+    try:
+        with open(path, 'a') as historyFile:
+            historyFile.write(json.dumps(record, sort_keys=True) + '\n')
+    except (IOError, OSError) as e:
+        myPrint("WARN: unable to append the run record to '%s' (%s)" %(path, e))
+
+#####################################################
+class ImportProgressDialog:
+    # Non-modal window refreshing the worker's counters. Cancel asks the worker to stop before its next txn.
+    # Create, and close, on the EDT
+
+    REFRESH_MILLIS = 250
+
+    def __init__(self, progress):
+        self.progress = progress
+        self.label = JLabel(progress.describe())
+        self.cancelButton = JButton("Cancel", actionPerformed=self.cancel)
+
+        panel = JPanel(BorderLayout(0, 10))
+        panel.setBorder(EmptyBorder(10, 10, 10, 10))
+        panel.add(self.label, BorderLayout.CENTER)
+        panel.add(self.cancelButton, BorderLayout.SOUTH)
+
+        self.dialog = JDialog()
+        self.dialog.setTitle("Import Fidelity Investment txns")
+        self.dialog.setModal(False)
+        self.dialog.setDefaultCloseOperation(JDialog.DO_NOTHING_ON_CLOSE)
+        self.dialog.getContentPane().add(panel)
+        self.dialog.pack()
+        self.dialog.setLocationRelativeTo(None)
+        self.dialog.setVisible(True)
+
+        self.timer = Timer(self.REFRESH_MILLIS, self.refresh)
+        self.timer.start()
+
+    def refresh(self, event=None):
+        self.label.setText(self.progress.describe())
+        self.dialog.pack()
+
+    def cancel(self, event=None):
+        self.progress.cancel()
+        self.cancelButton.setEnabled(False)
+        self.cancelButton.setText("Cancelling...")
+
+    def close(self):
+        self.timer.stop()
+        self.dialog.dispose()
+#####################################################
+
+#####################################################
+class ImportMessage:
+    # An entry of an import's report: level ("ERROR", "WARN" or "INFO"), code naming the kind of problem (e.g.
+    # "unknownAction"), the text shown, and the file and csv row ({column: value}) it is about - None if not
+
+    def __init__(self, level, code, text, fileName=None, values=None):
+        self.level = level
+        self.code = code
+        self.text = text
+        self.fileName = fileName
+        self.values = values
+
+    def __str__(self): return self.text
+#####################################################
+
+#####################################################
+class PlannedTxn:
+    # A txn the plan will create, fully resolved - applyPlan() builds it without looking anything up again. warning is
+    # the text of why it will differ from the csv (e.g. recorded as Xfr), else None. heldRow is its row's timing so far
+    # (ImportStats.holdRow())
+
+    def __init__(self, importFile, fiTxnId, acctContext, date, txnType, securityAccount, action, amount, shares, warning=None,
+                 missingSecurity=None, heldRow=None):
+        self.importFile = importFile
+        self.fiTxnId = fiTxnId
+        self.acctContext = acctContext
+        self.date = date
+        self.txnType = txnType
+        self.securityAccount = securityAccount
+        self.action = action
+        self.amount = amount
+        self.shares = shares
+        self.warning = warning
+        self.missingSecurity = missingSecurity  # the MissingSecurity to be added before the txn is built (no securityAccount yet)
+        self.heldRow = heldRow
+#####################################################
+
+#####################################################
+class ImportPlan:
+    # What an import will do, worked out read-only by planImport() and committed as it stands by applyPlan():
+    #   txns     - the PlannedTxns, in commit order
+    #   skipped  - [(importFile, date, fiTxnId, reason)] the duplicates, only listed with listSkipped (a dry run) -
+    #              otherwise just counted, and recorded in the watermarks as they are found
+    #   errored  - [(importFile, reason, {column: value})] the rows that cannot be imported
+    #   messages - [ImportMessage], the report
+    # Rows dropped before they were keyed (dated before the watermark, or already in an earlier file) are only counted,
+    # in each ImportFile. watermarks / txnIdIndex / legacyMigration are those the plan was made against (online only).
+    # missingSecurities (MissingSecurities) are the securities to add when applied - with the createSecurities option
+
+    SKIP_IN_BOOK = "already in the book"
+    SKIP_IN_IMPORT = "duplicate within this import"
+
+    def __init__(self, importFiles, online, listSkipped=False):
+        self.importFiles = importFiles
+        self.online = online
+        self.txns = []
+        self.skipped = [] if (listSkipped) else None
+        self.errored = []
+        self.messages = []
+        self.cancelled = False
+        self.watermarks = None
+        self.txnIdIndex = None
+        self.legacyMigration = None
+        self.missingSecurities = None
+
+    def report(self, level, code, text, importFile=None, row=None):
+        message = ImportMessage(level, code, text, importFile.name if (importFile) else None,
+                                importFile.schema.describe(row) if (row is not None) else None)
+        self.messages.append(message)
+        myPrint(text)
+        return message
+
+    def addError(self, importFile, reason, row):
+        self.errored.append((importFile, reason, importFile.schema.describe(row)))
+        importFile.countSkipped += 1
+
+    def rows(self):
+        # Generator: (status, file name, date, reason, detail) of each row planned - status "create", "skip" or "error"
+        for planned in self.txns:
+            yield "create", planned.importFile.name, planned.date, planned.warning or "", planned.action
+        for importFile, date, fiTxnId, reason in (self.skipped or []):
+            yield "skip", importFile.name, date, reason, fiTxnId
+        for importFile, reason, values in self.errored:
+            yield "error", importFile.name, None, reason, values
+
+    def summary(self, countCreated, countDuplicates, dryRun=False, confirm=False):
+        # the report of an import done - or, with dryRun / confirm, of the plan (confirm: as the plan is about to be applied)
+        if (confirm):
+            msg = "About to create %s transactions" %(countCreated)
+            if (countDuplicates): msg += "\nWill ignore %s duplicate transactions" %(countDuplicates)
+        elif (dryRun):
+            msg = "DRY RUN - nothing imported yet\nWould create %s transactions" %(countCreated)
+            if (countDuplicates): msg += "\nWould ignore %s duplicate transactions" %(countDuplicates)
+        elif (countDuplicates):
+            msg = "Created %s transactions\nIgnored %s duplicate transactions" %(countCreated, countDuplicates)
+        else:
+            msg = "Created %s transactions" %(countCreated)
+        if (self.errored):
+            msg += "\n%s rows not imported because of errors" %(len(self.errored))
+        countOlder = sum([importFile.countOlder for importFile in self.importFiles])
+        if (countOlder):
+            msg += "\nSkipped %s rows dated before the last import (use the forceFullCheck option to check them)" %(countOlder)
+        if (len(self.importFiles) > 1):
+            planned = dryRun or confirm
+            msg += '\n\n' + '\n'.join(["%s: %s %s, duplicates %s" %(importFile.name, "to create" if (planned) else "created",
+                                                                     importFile.countPlanned if (planned) else importFile.countCreated,
+                                                                     importFile.countDuplicates)
+                                      for importFile in self.importFiles])
+        if (self.messages):
+            msg += '\n\n' + ''.join([message.text + '\n' for message in self.messages]) + ' '; # + ' ' needed to not skip last word of message
+        return msg
+#####################################################
+
+#####################################################
+class ImportOptions:
+    # The import's settings, defaulted as for the menu action - any can be overridden by keyword
+
+    def __init__(self, **overrides):
+        self.accountNamePrefix = 'Fidelity '
+        self.debug = 0
+        self.online = 1
+        self.commitChunkSize = 500   # txns synced per batch (balances / UI refresh are deferred until each batch completes)
+        self.parseThreads = 4        # files parsed concurrently when several are imported together
+        self.forceFullCheck = 0      # 1 = ignore the import watermarks and imported file fingerprints - every row is checked
+        self.runHistoryPath = None   # file the json run record of each import is appended to (one line per run)
+        self.dryRun = 0              # 1 = only plan: report what would be imported, changing nothing
+        self.confirmPlan = 1         # 1 = show the plan and ask before applying it
+        self.createSecurities = 0    # 1 = add the securities missing from an account (linking existing ones by ticker) before importing - not record their rows as Xfr
+        self.undoBatch = None        # "last" or a batch id = instead of importing, delete the txns that batch created
+        for name, value in overrides.items():
+            if (not hasattr(self, name)): raise TypeError("unknown import option: '%s'" %(name))
+            setattr(self, name, value)
+#####################################################
+
+#####################################################
+class ImportUI:
+    # What runImport() needs of its user interface. This base class is the headless one (scripted runs, benchmarks):
+    # messages are left on the console and the account for a csv without an account column comes from
+    # accountsForFiles {file name: investment account name}, else defaultAccountName
+
+    def __init__(self, accountsForFiles=None, defaultAccountName=None):
+        self.accountsForFiles = accountsForFiles or {}
+        self.defaultAccountName = defaultAccountName
+
+    def selectAccount(self, investAccountNames, fileName):
+        # returns one of investAccountNames (the lower case names), or None to skip the file
+        accountName = self.accountsForFiles.get(fileName, self.defaultAccountName)
+        if (accountName is None): return None
+        accountName = accountName.strip().lower()
+        return accountName if (accountName in investAccountNames) else None
+
+    def confirm(self, msg): return True
+
+    def showInfo(self, msg): pass
+
+    def showError(self, msg): pass
+
+    def startProgress(self, progress): pass
+
+    def stopProgress(self): pass
+
+    def setSuspendRefresh(self, suspend): pass
+#####################################################
+
+#####################################################
+class SwingImportUI(ImportUI):
+    # The Moneydance UI - dialogs and the refresh suspension are run on the EDT (the import runs on its own thread)
+
+    def __init__(self, mdGUI):
+        ImportUI.__init__(self)
+        self.mdGUI = mdGUI
+        self.progressDialog = None
+
+    def selectAccount(self, investAccountNames, fileName):
+        return runOnEDT(selectInvestAccountName, investAccountNames, fileName)
+
+    def confirm(self, msg):
+        choice = runOnEDT(JOptionPane.showConfirmDialog, None, msg, "Import Fidelity", JOptionPane.YES_NO_OPTION)
+        return choice == JOptionPane.YES_OPTION
+
+    def showInfo(self, msg): runOnEDT(self.mdGUI.showInfoMessage, msg)
+
+    def showError(self, msg): runOnEDT(self.mdGUI.showErrorMessage, msg)
+
+    def startProgress(self, progress):
+        self.progressDialog = runOnEDT(ImportProgressDialog, progress)
+
+    def stopProgress(self):
+        if (self.progressDialog is None): return
+        runOnEDT(self.progressDialog.close)
+        self.progressDialog = None
+
+    def setSuspendRefresh(self, suspend): runOnEDT(self.mdGUI.setSuspendRefresh, suspend)
+#####################################################
 
 def dump():
     tb = traceback.format_exc()
@@ -130,7 +1886,559 @@ def dump():
     myPrint(theText)
 
 
+def planImport(book, ui, csvFileNames, options, progress, stats):
+    # Works out what importing the csv files into book would do - read-only, nothing in the book (or its local storage)
+    # is changed: accounts, dates, duplicates, txn types and securities are all resolved here. Reports through ui (an
+    # ImportUI), counts into progress (an ImportProgress) and times into stats (an ImportStats). Returns an
+    # ImportPlan. Raises QuickAbortThisScriptException once it has told ui why not
+    accountNamePrefix = options.accountNamePrefix
+    online = options.online
+    parseThreads = options.parseThreads
+    forceFullCheck = options.forceFullCheck
+
+    actionClassifier = ActionClassifier([(getattr(InvestTxnType, name), substrings) for name, substrings in ACTION_RULES])
+    securityLookup = None
+    missingSecurities = MissingSecurities(book) if (options.createSecurities) else None
+
+    try:
+        t = time.time()
+        plan = ImportPlan([ImportFile(csvFileName) for csvFileName in csvFileNames], online, options.dryRun)
+        importFiles = plan.importFiles
+
+        watermarks = ImportWatermarks(book, FIID, PROTOCOL_ID) if (online) else None
+        plan.watermarks = watermarks
+
+        # Every file's layout is checked before anything is imported
+        for importFile in importFiles:
+            try:
+                importFile.readHeader()
+            except CsvSchemaError as e:
+                msg = "ERROR: '%s': %s" %(importFile.name, e)
+                myPrint(msg)
+                ui.showError(msg)
+                raise QuickAbortThisScriptException
+            myPrint("'%s' csv layout: %s (%s, delimiter %r)" %(importFile.name, importFile.schema.dialect,
+                                                                importFile.reader.encoding, importFile.reader.delimiter))
+        progress.bytesTotal = sum([importFile.reader.size for importFile in importFiles])
+
+        # Create dicts of investment accounts by name and by number
+        allAccounts = AccountUtil.allMatchesForSearch(book, AcctFilter.ALL_ACCOUNTS_FILTER)
+        investAccountsByName = {}
+        investAccountsByNumber = {}
+        for account in allAccounts:
+            if account.getAccountType() == Account.AccountType.INVESTMENT:
+                accountName = account.getAccountName().strip().lower()
+                if accountName:
+                    if accountName in investAccountsByName:
+                        plan.report("WARN", "duplicateAccountName", "WARN: more than one investment account with name: '%s'" %(accountName))
+                    else:
+                        investAccountsByName[accountName] = account
+
+                accountNumber = account.getInvestAccountNumber().strip().lower()
+                if accountNumber:
+                    if accountNumber in investAccountsByNumber:
+                        plan.report("WARN", "duplicateAccountNumber", "WARN: more than one investment account with number: '%s'" %(accountNumber))
+                    else:
+                        investAccountsByNumber[accountNumber] = account
+
+        accountResolver = AccountResolver(investAccountsByName, investAccountsByNumber, accountNamePrefix, MD_REF.getBuild())
+        stats.lap("setup", t)
+
+        # csv files without an account column are for a single account - ask which, up front
+        for importFile in list(importFiles):
+            if (importFile.schema.has("account")): continue
+            investAccountNames = sorted(investAccountsByName.keys())
+            selection = ui.selectAccount(investAccountNames, importFile.name)
+            if selection is None:
+                plan.report("INFO", "noAccountSelected", "No investment account selected for '%s' - file skipped" %(importFile.name), importFile)
+                importFiles.remove(importFile)
+                continue
+            importFile.acctContext = accountResolver.contextFor(investAccountsByName[selection])
+
+        # An identical file is only skipped whilst the txns it created are still in the accounts it was imported into
+        if (watermarks and not forceFullCheck):
+            batches = ImportBatches(book)
+            for importFile in list(importFiles):
+                found = watermarks.findImportedFile(importFile.path)
+                if (found is None): continue
+                fingerprint, importedFile = found
+                acctIDs = importedFile.get("accounts") or []
+                if ((importFile.acctContext and acctIDs != [importFile.acctContext.acctID])
+                        or not batches.isInBook(importedFile.get("batch"), acctIDs)):
+                    myPrint("'%s' is identical to '%s' imported %s, but not into the same account or its txns have gone - checking it again"
+                            %(importFile.name, importedFile["name"], importedFile["imported"]))
+                    watermarks.forgetFile(fingerprint)
+                    continue
+                plan.report("INFO", "fileAlreadyImported",
+                            "'%s' is identical to '%s' imported %s - skipped (use the forceFullCheck option to check it again)" %(importFile.name, importedFile["name"], importedFile["imported"]),
+                            importFile)
+                importFiles.remove(importFile)
+                stats.count("filesAlreadyImported")
+
+        ui.startProgress(progress)
+        t = time.time()     # (the time waiting on the user is not counted)
+
+        txnIdIndex = None
+        if (online):
+            # Until the legacy ids have been migrated (by applyPlan()) the index reads them as they are
+            plan.legacyMigration = LegacyTxnIdMigration(book, JSON_PROTOCOL_ID, OLD_PROTOCOL_ID)
+            txnIdIndex = FiTxnIdIndex(book, FIID, PROTOCOL_ID, JSON_PROTOCOL_ID,
+                                      None if (plan.legacyMigration.isComplete()) else OLD_PROTOCOL_ID)
+            plan.txnIdIndex = txnIdIndex
+            t = stats.lap("index load", t)
+
+        checkedWatermarks = set()
+        watermarksLock = threading.Lock()       # batch mode calls beforeWatermark() from the parser threads
+
+        def beforeWatermark(importFile, row):
+            schema = importFile.schema
+            acctContext = importFile.acctContext or accountResolver.lookup(schema.get(row, "account"), schema.get(row, "accountNumber"))
+            if (acctContext is None): return False
+            if (acctContext.acctID not in checkedWatermarks):
+                with watermarksLock:
+                    # txns added / deleted by hand since the last import - the account's watermark no longer says what
+                    # is there. Only marked checked once dropped, so no other thread reads the stale watermark meanwhile
+                    if (acctContext.acctID not in checkedWatermarks):
+                        if (not txnIdIndex.isUnchanged(acctContext.account)):
+                            if (watermarks.forgetAccount(acctContext.acctID)): stats.count("watermarksDropped")
+                        checkedWatermarks.add(acctContext.acctID)
+            if (not watermarks.isBefore(acctContext.acctID, importFile.dateConverter.toDateInt(schema.get(row, "date")))): return False
+            importFile.countOlder += 1
+            return True
+
+        skipRow = beforeWatermark if (watermarks and not forceFullCheck) else None
+
+        if (len(importFiles) == 1):
+            # The rows stream through: read -> filter -> key -> account / dedup -> plan. Only the current row is held,
+            # and a compact PlannedTxn (not the row) for each txn to create
+            importRows = ((importFiles[0], fiTxnId, row) for fiTxnId, row in importFiles[0].keyedRows(progress, online, skipRow))
+            rowsStage = "read"
+        else:
+            # Batch: the files are read and keyed concurrently, then merged (dropping txns present in more than one file)
+            # - only the keys are held. The kept rows are read again to be planned, and the plan put in date order.
+            # The book's fiTxnId index is built once per account for them all
+            parsedFiles = parallelMap(lambda importFile: importFile.parse(progress, online, skipRow), importFiles, parseThreads,
+                                      progress.isCancelled)
+            if (progress.isCancelled()): parsedFiles = [[] for _importFile in importFiles]
+            readStart = t
+            t = stats.lap("read (parallel)", t)
+            readSecs = t - readStart
+            # the keying's share of the files' parse time, as a share of the (concurrent) read's elapsed time
+            parseSecs = sum([importFile.parseSecs for importFile in importFiles])
+            if (parseSecs):
+                stats.moveSecs("read (parallel)", "keying (parallel)",
+                               readSecs * sum([importFile.keySecs for importFile in importFiles]) / parseSecs,
+                               sum([importFile.countKeyed for importFile in importFiles]))
+            keptRows = mergeImportFiles(importFiles, parsedFiles)
+            del parsedFiles
+            importRows = rereadImportFiles(importFiles, keptRows)
+            crossFileDuplicates = sum([importFile.countDuplicates for importFile in importFiles])
+            progress.countDuplicates += crossFileDuplicates
+            stats.count("crossFileDuplicates", crossFileDuplicates)
+            stats.lap("merge", t)
+            rowsStage = "reread"
+
+        securityLookup = SecurityLookup(book)
+        securityLookup.startListening()
+
+        plannedKeys = set()     # (account uuid, fiTxnId) of the txns planned so far
+
+        for importFile, fiTxnId, row in stats.timedRows(rowsStage, importRows):
+            t = stats.lastLap
+            if (progress.isCancelled()):
+                plan.cancelled = True
+                plan.report("INFO", "cancelled", "Import CANCELLED - nothing imported")
+                break
+
+            schema = importFile.schema
+
+            if (importFile.acctContext):
+                acctContext = importFile.acctContext
+            else:
+                acctContext, txt = accountResolver.resolve(schema.get(row, "account"), schema.get(row, "accountNumber"))
+                if (txt): plan.report("ERROR", "accountNotFound", txt, importFile, row)
+            t = stats.lap("account resolution", t)
+
+            if (acctContext is None):
+                plan.addError(importFile, "account not found", row)
+                continue
+            importFile.acctIDs.add(acctContext.acctID)
+
+            account = acctContext.account
+            rowAction = schema.get(row, "action")
+            date_string = schema.get(row, "date")
+
+            date = importFile.dateConverter.toDateInt(date_string)
+            t = stats.lap("date conversion", t)
+            if (date is None):
+                plan.report("ERROR", "badDate", "ERROR: unrecognised date: '%s' - row skipped: %s" %(date_string, schema.describe(row)), importFile, row)
+                plan.addError(importFile, "unrecognised date", row)
+                continue
+
+            if (online):
+                # (forceFullCheck: only the index, which confirms the txn is still in the book - not the watermarks)
+                if ((not forceFullCheck and watermarks.isBoundaryDuplicate(acctContext.acctID, date, fiTxnId)) or txnIdIndex.contains(account, fiTxnId)
+                        or (useStuartsKey and importFile.isStuartsKeyInBook(txnIdIndex, account, row))):
+                    reason = ImportPlan.SKIP_IN_BOOK
+                elif ((acctContext.acctID, fiTxnId) in plannedKeys):
+                    reason = ImportPlan.SKIP_IN_IMPORT
+                else:
+                    reason = None
+                    plannedKeys.add((acctContext.acctID, fiTxnId))
+                t = stats.lap("dedup search", t)
+                if (reason):
+                    # a row already in the book counts towards the account's watermark as a txn created would - only
+                    # taking effect if the plan is applied (ImportWatermarks.commit())
+                    if (reason == ImportPlan.SKIP_IN_BOOK): watermarks.record(acctContext.acctID, date, fiTxnId)
+                    if (plan.skipped is not None): plan.skipped.append((importFile, date, fiTxnId, reason))
+                    progress.countDuplicates += 1
+                    importFile.countDuplicates += 1
+                    stats.count("bookDuplicates")
+                    continue
+
+            action = rowAction
+            warning = None
+            txnType = actionClassifier.classify(action)
+            if (txnType is None):
+                symbol = schema.get(row, "symbol").strip()
+                if (symbol):
+                    warning = plan.report("ERROR", "unknownAction", "ERROR: unknown action: '%s' . Will record as Xfr" %(action), importFile, row)
+                txnType = InvestTxnType.BANK
+            t = stats.lap("classification", t)
+
+            securityAccount = None
+            missingSecurity = None
+            if (txnType in [InvestTxnType.BUY, InvestTxnType.SELL, InvestTxnType.DIVIDEND, InvestTxnType.BUY_XFER, InvestTxnType.SELL_XFER, InvestTxnType.MISCINC, InvestTxnType.DIVIDEND_REINVEST, InvestTxnType.MISCEXP]):
+                csvDescription = schema.get(row, "description")
+                symbol = schema.get(row, "symbol")     # not present in retirement account CSV files
+
+                securityAccount = securityLookup.getSecurityAcct(account, csvDescription, symbol)
+                if (not securityAccount and missingSecurities is not None):
+                    missingSecurity, isNew = missingSecurities.add(account, csvDescription, symbol)
+                    if (isNew):
+                        plan.report("INFO", "securityToAdd", "Security '%s' '%s' will be added to invest account '%s'" %(missingSecurity.name, missingSecurity.tickerSymbol, account.getAccountName()),
+                                    importFile, row)
+                t = stats.lap("security lookup", t)
+                if (not securityAccount and not missingSecurity):
+                    warning = plan.report("ERROR", "securityAccountNotFound", "ERROR: security account: '%s' '%s' NOT found when processing invest account '%s.' Please manually create security and/or add it to the invest account. Will process as Xfr" %(csvDescription, symbol, account.getAccountName()),
+                                          importFile, row)
+                    txnType = InvestTxnType.BANK
+                elif (securityAccount and not securityAccount.getCurrencyType()):
+                    warning = plan.report("ERROR", "securityNotFound", "ERROR: security: '%s' '%s' NOT found. Will process as Xfr" %(csvDescription, symbol), importFile, row)
+                    txnType = InvestTxnType.BANK
+                    securityAccount = None
+
+            try:
+                amount = parseAmount(schema.get(row, "amount"))
+                shares = 0.0
+                if ((securityAccount or missingSecurity) and txnType not in [InvestTxnType.DIVIDEND, InvestTxnType.MISCINC, InvestTxnType.MISCEXP]):
+                    shares = abs(parseAmount(schema.get(row, "quantity")))
+            except ValueError:
+                plan.report("ERROR", "badAmount", "ERROR: unreadable amount / quantity - row skipped: %s" %(schema.describe(row)), importFile, row)
+                plan.addError(importFile, "unreadable amount / quantity", row)
+                continue
+
+            stats.lap("planning", t)
+            plan.txns.append(PlannedTxn(importFile, fiTxnId, acctContext, date, txnType, securityAccount, action, amount, shares,
+                                        warning and warning.text, missingSecurity, stats.holdRow()))
+            importFile.countPlanned += 1
+        stats.endRow(time.time())
+        if (len(importFiles) == 1):
+            # the rows were keyed as they were read - the keying is timed by keyRows()
+            stats.moveSecs("read", "keying", importFiles[0].keySecs, importFiles[0].countKeyed)
+        else:
+            # the files were planned one after another - the txns are committed in date order (then file, then row)
+            plan.txns.sort(key=lambda planned: planned.date)
+
+        if (progress.isCancelled() and not plan.cancelled):
+            # cancelled whilst the files were being read (the reading stops at the next batch)
+            plan.cancelled = True
+            plan.report("INFO", "cancelled", "Import CANCELLED - nothing imported")
+
+        stats.counters.update({"rowsRead": progress.countRowsParsed,
+                               "rowsRepeatedInFile": sum([importFile.countRepeated for importFile in importFiles]),
+                               "rowsBeforeWatermark": sum([importFile.countOlder for importFile in importFiles]),
+                               "rowsErrored": len(plan.errored),
+                               "accountCacheHits": accountResolver.countHits,
+                               "accountCacheMisses": len(accountResolver.resolved),
+                               "dateCacheHits": sum([importFile.dateConverter.countHits for importFile in importFiles]),
+                               "dateCacheMisses": sum([len(importFile.dateConverter.cache) for importFile in importFiles]),
+                               "actionCacheHits": actionClassifier.countHits,
+                               "actionCacheMisses": len(actionClassifier.cache),
+                               "securityLookups": securityLookup.countLookups,
+                               "securityIndexHits": securityLookup.countLookups - securityLookup.countIndexBuilds,
+                               "securityIndexBuilds": securityLookup.countIndexBuilds})
+        if (missingSecurities): stats.count("securitiesToAdd", len(missingSecurities))
+        plan.missingSecurities = missingSecurities
+        if (txnIdIndex): stats.count("fiTxnIdIndexAccountsRebuilt", txnIdIndex.countRebuilt)
+        return plan
+
+    finally:
+        if (securityLookup): securityLookup.stopListening()
+
+def applyPlan(book, ui, plan, options, progress, stats):
+    # Commits the plan (from planImport()) as it stands - the txns are built from their PlannedTxns, nothing is looked
+    # up again. Runs the legacy fiTxnId migration first if still pending. The txns created are recorded as one
+    # ImportBatches batch (its id set in progress.batchId), so the run can be undone. Returns the summary message
+    online = plan.online
+    watermarks = plan.watermarks
+    txnIdIndex = plan.txnIdIndex
+    batches = ImportBatches(book)
+    batch = batches.newBatch([importFile.name for importFile in plan.importFiles])
+    manifest = {}
+
+    ui.startProgress(progress)
+    t = time.time()
+
+    if (online and not plan.legacyMigration.isComplete()):
+        for acctID in plan.legacyMigration.run(): txnIdIndex.invalidateAccount(acctID)
+        stats.count("legacyIdsMigrated", plan.legacyMigration.countMigrated)
+        stats.count("legacyIdsNotMigrated", plan.legacyMigration.countFailed)
+        t = stats.lap("legacy migration", t)
+
+    # the securities missing from the accounts are all added before the first txn is built
+    missingSecurities = plan.missingSecurities
+    if (missingSecurities):
+        ui.setSuspendRefresh(True)
+        try:
+            missingSecurities.create()
+        finally:
+            ui.setSuspendRefresh(False)
+        for planned in plan.txns:
+            if (planned.missingSecurity): planned.securityAccount = planned.missingSecurity.securityAccount
+        stats.counters.update({"securitiesLinked": missingSecurities.countLinked, "securitiesCreated": missingSecurities.countCreated,
+                               "securitySubAccountsReused": missingSecurities.countReused})
+        t = stats.lap("security creation", t)
+
+    def txnCommitted(pTxn, account, fiTxnId, date, importFile):
+        if (online):
+            txnIdIndex.add(account, pTxn, fiTxnId, date)
+            watermarks.record(account.getUUID(), date, fiTxnId)
+        manifest.setdefault(account.getUUID(), []).append([pTxn.getUUID(), fiTxnId])
+        progress.countCreated += 1
+        importFile.countCreated += 1
+
+    commitBatch = TxnCommitBatch(book, ui, options.commitChunkSize, txnCommitted)
+
+    try:
+        commitPlannedTxns(book, plan, progress, stats, commitBatch, batch["id"])
+    finally:
+        # whatever was committed (even if the run failed part way) can be undone
+        if (manifest):
+            batches.saveBatch(batch, manifest)
+            progress.batchId = batch["id"]
+
+    t = time.time()
+    if (online):
+        txnIdIndex.save()
+
+        # the watermarks only move on when every row has been looked at
+        if (not progress.isCancelled()):
+            watermarks.commit()
+            # a file is known as imported by the txns it created - one that created none is simply checked again
+            for importFile in plan.importFiles:
+                if (importFile.countSkipped or not importFile.countCreated or not progress.batchId): continue
+                batch["fingerprints"].append(watermarks.addImportedFile(importFile.path, importFile.name,
+                                                                        importFile.acctIDs, progress.batchId))
+            watermarks.save()
+            if (manifest): batches.save()
+        stats.lap("save", t)
+
+    stats.counters.update({"syncs": commitBatch.countSynced, "commitChunks": commitBatch.countChunks})
+    msg = plan.summary(progress.countCreated, progress.countDuplicates)
+    if (missingSecurities):
+        msg = "Added %s securities to invest accounts (%s new securities)\n" %(len(missingSecurities) - missingSecurities.countReused, missingSecurities.countCreated) + msg
+    if (progress.batchId): msg = "Import batch %s (can be undone)\n" %(progress.batchId) + msg
+    return msg
+
+def commitPlannedTxns(book, plan, progress, stats, commitBatch, batchId):
+    # applyPlan()'s txn loop: builds each planned txn, tagged with batchId, and hands it to commitBatch. Each txn's
+    # time is added to its row's (held since planning), for the slowest rows
+    online = plan.online
+
+    def resumeRow(planned):
+        heldRow, planned.heldRow = planned.heldRow, None
+        return heldRow
+
+    for planned in stats.timedRows("next txn", plan.txns, resumeRow):
+        t = stats.lastLap
+        if (progress.isCancelled()):
+            plan.cancelled = True
+            plan.report("INFO", "cancelled", "Import CANCELLED - remaining rows not processed")
+            break
+
+        acctContext = planned.acctContext
+        txnType = planned.txnType
+        date = planned.date
+        desc = planned.action
+        memo = planned.action
+        niceCheckNum = ""
+
+        pTxn = ParentTxn.makeParentTxn(
+            book,
+            date,
+            date,
+            uniqueTime(),
+            niceCheckNum,
+            acctContext.account,
+            desc,
+            memo,
+            -1L,
+            AbstractTxn.ClearedStatus.UNRECONCILED.legacyValue())                                               # noqa
+
+        fields = InvestFields()
+        if (planned.securityAccount):
+            fields.setFieldStatus(txnType, pTxn)
+            fields.security = planned.securityAccount
+            fields.amount = fields.curr.getLongValue(abs(planned.amount))
+
+            if (txnType == InvestTxnType.DIVIDEND or txnType == InvestTxnType.MISCINC or txnType == InvestTxnType.MISCEXP):
+                fields.shares = 0
+                fields.price = 1
+            else:
+                totalAmount = abs(planned.amount)
+                shares = planned.shares
+                price = 1.0 if (totalAmount == 0.0 or shares == 0.0) else totalAmount/shares
+
+                fields.shares = planned.securityAccount.getCurrencyType().getLongValue(shares)
+                fields.price = price
+
+        if (txnType == InvestTxnType.BANK):
+            fields.setFieldStatus(txnType, pTxn)
+            fields.amount = fields.curr.getLongValue(planned.amount)
+
+        fields.date = date
+        fields.taxDate = date
+        fields.checkNum = niceCheckNum
+        fields.payee = desc
+        fields.memo = memo
+
+        fields.xfrAcct = acctContext.xfrAcct
+        fields.fee = 0
+        fields.feeAcct = acctContext.feeAcct
+        fields.category = acctContext.category
+        fields.storeFields(pTxn)
+        pTxn.setIsNew(1)
+        if (online):
+            pTxn.setFIID(FIID)
+            pTxn.setFiTxnId(PROTOCOL_ID, planned.fiTxnId)
+            pTxn.setParameter("ol.orig-payee", desc)
+            pTxn.setParameter("ol.orig-memo", memo)
+        pTxn.setParameter(ImportBatches.TXN_PARAMETER, batchId)
+        t = stats.lap("field storage", t)
+        commitBatch.add(pTxn, acctContext.account, planned.fiTxnId, date, planned.importFile)
+        stats.lap("commit", t)
+
+    # NOTE: a failing txn raises before reaching here, so the (unsynced) txns of its partial batch are dropped
+    commitBatch.flush()
+    stats.lap("commit", stats.lastLap)
+
+def runImport(book, ui, csvFileNames, options, progress):
+    # The import itself - the csv files into book: planned, then (unless a dry run, or the plan is declined) applied.
+    # Reports through ui (an ImportUI) and counts into progress (an ImportProgress), whose runRecord is set to the
+    # run's ImportStats.record(). Returns the summary message. Raises QuickAbortThisScriptException once it has told
+    # ui why not
+    stats = ImportStats(options.debug)
+    try:
+        plan = planImport(book, ui, csvFileNames, options, progress, stats)
+        ui.stopProgress()
+        progress.plan = plan
+
+        if (options.dryRun):
+            msg = plan.summary(len(plan.txns), progress.countDuplicates, dryRun=True)
+        elif (plan.cancelled):
+            msg = plan.summary(0, progress.countDuplicates)
+        elif (plan.txns and options.confirmPlan
+              and not ui.confirm(plan.summary(len(plan.txns), progress.countDuplicates, confirm=True) + "\n\nImport these transactions?")):
+            plan.report("INFO", "declined", "Plan declined - nothing imported")
+            msg = plan.summary(0, progress.countDuplicates)
+        else:
+            msg = applyPlan(book, ui, plan, options, progress, stats)
+        myPrint(msg)
+
+        stats.endHeldRows([planned.heldRow for planned in plan.txns])
+        progress.runRecord = stats.record(progress, plan.importFiles, options)
+        myPrint(ImportStats.describe(progress.runRecord))
+        myPrint("RUN RECORD: %s" %(json.dumps(progress.runRecord, sort_keys=True)))
+        if (options.runHistoryPath): appendRunRecord(options.runHistoryPath, progress.runRecord)
+        return msg
+
+    finally:
+        ui.stopProgress()
+
+def undoImport(book, ui, batchRef, options):
+    # Deletes the txns an earlier import created - batchRef is its batch id, or "last" - straight from the batch's
+    # manifest (no book search). The fiTxnId index drops them too, and the watermarks of the accounts affected (and the
+    # fingerprints of the batch's files) are forgotten, so importing the same files again recreates the txns. Txns
+    # already deleted, or no longer carrying the batch id, are left alone. Returns the summary message. Raises
+    # QuickAbortThisScriptException once it has told ui why not
+    batches = ImportBatches(book)
+    batch = batches.find(batchRef)
+    manifest = batches.loadManifest(batch) if (batch) else None
+    if (manifest is None):
+        msg = "ERROR: import batch '%s' not found - the batches that can be undone:\n%s" %(batchRef, batches.describe() or "(none)")
+        myPrint(msg)
+        ui.showError(msg)
+        raise QuickAbortThisScriptException
+    if (batch["undone"]):
+        msg = "Import batch %s was already undone %s" %(batch["id"], batch["undone"])
+        myPrint(msg)
+        ui.showInfo(msg)
+        raise QuickAbortThisScriptException
+    if (not ui.confirm("Undo import batch %s?\n\nDeletes the %s transactions imported %s from:\n%s"
+                       %(batch["id"], batch["count"], batch["started"], "\n".join(batch["files"])))):
+        raise QuickAbortThisScriptException
+
+    txnSet = book.getTransactionSet()
+    txnIdIndex = FiTxnIdIndex(book, FIID, PROTOCOL_ID, JSON_PROTOCOL_ID) if (options.online) else None
+    toDelete = []
+    countGone = 0
+    for acctID, txns in manifest.items():
+        for txnID, fiTxnId in txns:
+            txn = txnSet.getTxnByID(txnID)
+            if (txn is None or txn.getParameter(ImportBatches.TXN_PARAMETER, None) != batch["id"]):
+                countGone += 1
+                continue
+            # the index entry is dropped before the delete changes the account's txn count
+            if (txnIdIndex): txnIdIndex.discard(txn.getAccount(), fiTxnId)
+            toDelete.append(txn)
+
+    ui.setSuspendRefresh(True)
+    book.setRecalcBalances(False)
+    try:
+        for txn in toDelete: txn.deleteItem()
+    finally:
+        book.setRecalcBalances(True)
+        ui.setSuspendRefresh(False)
+
+    if (txnIdIndex):
+        txnIdIndex.save()
+        watermarks = ImportWatermarks(book, FIID, PROTOCOL_ID)
+        for acctID in batch["accounts"]: watermarks.forgetAccount(acctID)
+        for fingerprint in batch["fingerprints"]: watermarks.forgetFile(fingerprint)
+        watermarks.save()
+    batches.markUndone(batch)
+
+    msg = "Undid import batch %s\nDeleted %s transactions" %(batch["id"], len(toDelete))
+    if (countGone): msg += "\n%s transactions already deleted or changed - left alone" %(countGone)
+    myPrint(msg)
+    return msg
+
+def runHeadless(csvFileNames, accountsForFiles=None, defaultAccountName=None, **options):
+    # Scripted entry point, without Swing: imports csvFileNames into the current book. The account for a csv without
+    # an account column is taken from accountsForFiles {file name: investment account name} or defaultAccountName.
+    # options override ImportOptions. Returns (summary message, ImportProgress)
+    progress = ImportProgress()
+    summary = runImport(MD_REF.getCurrentAccountBook(), ImportUI(accountsForFiles, defaultAccountName), csvFileNames,
+                        ImportOptions(**options), progress)
+    return summary, progress
+
+def runHeadlessUndo(batchRef="last", **options):
+    # Scripted undo of an earlier import (see undoImport()) in the current book. Returns the summary message
+    return undoImport(MD_REF.getCurrentAccountBook(), ImportUI(), batchRef, ImportOptions(**options))
+
 def doMain():
+    # Runs on a worker thread (not the EDT) so Moneydance stays responsive - Swing calls go through runOnEDT()
     # initialise these here so that their scope is local to doMain - i.e. they will evaporate once doMain completes
     global MD_REF
     mdGUI = MD_REF.getUI()
@@ -140,366 +2448,60 @@ def doMain():
     prefs = MD_REF.getPreferences()
 
     # define locally scoped variables here...
-    csvFileName = None
-    # csvFileName = '/Users/username/Downloads/fidelity.csv'
-    accountNamePrefix = 'Fidelity '
-    debug = 0
-    online = 1
+    csvFileNames = None
+    # csvFileNames = ['/Users/username/Downloads/fidelity.csv']
+    options = ImportOptions()
+    # options.forceFullCheck = 1
+    # options.dryRun = 1
+    # options.undoBatch = "last"
     MY_IMPORT_DIR_KEY = "custom_fidelity_import_dir"
 
-    FIID = 'script:import_fidelity.py'
-    protocolId = 100 # change to 100
-    oldProtocolId = 99
-
-    buyStrings = [' BOUGHT ', 'REINVESTMENT ', 'Contributions', 'PURCHASE ']
-    buyXferStrings = [ 'TRANSFER OF ASSETS ACAT RECEIVE' ]
-    sellStrings = ['REDEMPTION ', 'SOLD ', 'IN LIEU OF FRX SHARE']
-    sellXferStrings = [ 'TRANSFER OF ASSETS ACAT DELIVER' ]
-    divStrings = ['DIVIDEND RECEIVED ', 'REGULATORY FEE ADJ']
-    divReinvestStrings = ['Dividend']
-    incStrings = ['LONG-TERM', 'SHORT-TERM']
-    miscExpStrings = ['FEE CHARGED', 'TAX PAID']
-
-    importantMessages = ''
+    ui = SwingImportUI(mdGUI)
+    claimed = False
 
     try:
 
-        if csvFileName is None:
+        # the import runs off the EDT, so the menu could start a second one against the same book and stored data
+        claimed = claimImportRun()
+        if (not claimed):
+            msg = "An import is already running (started %s) - please wait for it to finish" %(System.getProperty(IMPORT_RUNNING_PROPERTY))
+            myPrint(msg)
+            ui.showError(msg)
+            raise QuickAbortThisScriptException
+
+        if csvFileNames is None and not options.undoBatch:
 
-            fwin = mdGUI.getFileChooser(None, strings.choose_import_file + " (CSV, TSV, TXT)", FileDialog.LOAD,
-                                  FileExtensionFilter(["csv", "tsv", "txt"]), [MY_IMPORT_DIR_KEY, UserPreferences.IMPORT_DIR, UserPreferences.DATA_DIR])
-            fwin.setVisible(True)
-            fileName = fwin.getFile()
-            dirName = fwin.getDirectory()
+            selectedFiles, dirName = runOnEDT(chooseImportFiles, mdGUI, strings, MY_IMPORT_DIR_KEY)
 
-            if (fileName is None or dirName is None):
+            if (not selectedFiles or dirName is None):
                 msg = "No file selected - quitting"
                 myPrint(msg)
-                mdGUI.showInfoMessage(msg)
+                ui.showInfo(msg)
                 raise QuickAbortThisScriptException
 
             prefs.setSetting(MY_IMPORT_DIR_KEY, dirName)
-            
-            fileToImport = File(dirName, fileName)
-            myPrint("File selected: %s" %(fileToImport))
-            if (not fileToImport.exists() or not fileToImport.canRead()):
-                msg = strings.unable_to_read_file + ": " + fileToImport.getAbsolutePath()
+
+            csvFileNames = []
+            for fileToImport in selectedFiles:
+                myPrint("File selected: %s" %(fileToImport))
+                if (not fileToImport.exists() or not fileToImport.canRead()):
+                    msg = strings.unable_to_read_file + ": " + fileToImport.getAbsolutePath()
+                    myPrint(msg)
+                    ui.showError(msg)
+                    raise QuickAbortThisScriptException
+                csvFileNames.append(fileToImport.getAbsolutePath())
+
+            if (not csvFileNames):
+                msg = "No csv files found - quitting"
                 myPrint(msg)
-                mdGUI.showErrorMessage(msg)
+                ui.showInfo(msg)
                 raise QuickAbortThisScriptException
-            csvFileName = fileToImport.getAbsolutePath()
-
-        with open(csvFileName, 'rb') as csvFile:        # correct approach for python 2.7 - unicode strings...
-
-            # strip out BOM (if it exists)
-            first = csvFile.read(3)
-            if first != '\xef\xbb\xbf': csvFile.seek(0)
 
-            reader = csv.reader(csvFile)
-            firstRow = next(reader)
-
-            try:
-                while not any(firstRow): firstRow = next(reader)
-            except:
-                mdGUI.showErrorMessage("ERROR reading csv file")
-                raise
-
-            dict_reader = csv.DictReader(csvFile, fieldnames=firstRow)
-
-            countDuplicates = 0
-            if (online):
-                # Remove entries already in Moneydance
-                new_dict = {}
-                for row in dict_reader:
-                    if txnKey(row) in new_dict:
-                        # Duplicate entry in CSV file
-                        row['Unique']=str(uniqueTime())
-                    new_dict[txnKey(row)] = row
-
-                class IsMatch(TxnSearch):
-                    def matchesAll(self):
-                        return False
-
-                    def matches(self, txn):
-                        if isinstance(txn, ParentTxn):
-                            newTxnId = None
-                            oldTxnId = txn.getFiTxnId(oldProtocolId)
-                            if (oldTxnId):
-                                try:
-                                    loadedDict = ast.literal_eval(oldTxnId)
-                                    newTxnId = json.dumps(loadedDict, sort_keys=True, separators=(',', ':'))
-                                except ValueError as e:
-                                    print("Error evaluating string: {e}")
-
-                                if newTxnId:
-                                    txn.setEditingMode()
-                                    txn.setFiTxnId(protocolId, newTxnId)
-                                    txn.setFiTxnId(oldProtocolId, None)
-                                    txn.getParentTxn().syncItem()
-
-                            newTxnId = txn.getFiTxnId(protocolId)
-                            if (newTxnId):
-                                if (newTxnId in new_dict):
-                                   del new_dict[newTxnId]
-                                   return True
-                        else:
-                            return False
-
-                results = book.getTransactionSet().getTransactions(IsMatch())                                           # noqa
-                countDuplicates = results.getSize()
-                dict_reader = list(new_dict.values())
-
-
-            # Create dicts of investment accounts by name and by number
-            allAccounts = AccountUtil.allMatchesForSearch(book, AcctFilter.ALL_ACCOUNTS_FILTER)
-            investAccountsByName = {}
-            investAccountsByNumber = {}
-            for account in allAccounts:
-                if account.getAccountType() == Account.AccountType.INVESTMENT:
-                    accountName = account.getAccountName().strip().lower()
-                    if accountName:
-                        if accountName in investAccountsByName:
-                            txt = "WARN: more than one investment account with name: '%s'" %(accountName)
-                            importantMessages += txt + '\n';
-                            myPrint(txt)
-                        else:
-                            investAccountsByName[accountName] = account
-
-                    accountNumber = account.getInvestAccountNumber().strip().lower()
-                    if accountNumber:
-                        if accountNumber in investAccountsByNumber:
-                            txt = "WARN: more than one investment account with number: '%s'" %(accountNumber)
-                            importantMessages += txt + '\n';
-                            myPrint(txt)
-                        else:
-                            investAccountsByNumber[accountNumber] = account
-                
-            countCreated = 0
-            accountForSingleAccountCsv = None
-            for row in dict_reader:
-                if ('Action' not in row):
-                    if ('Transaction Type' not in row):
-                        continue
-                if ('Action' in row and not row['Action']):
-                    continue
-                if ('Transaction Type' in row and not row['Transaction Type']):
-                    continue
-                if (debug): myPrint(row)
-
-                account = None
-                if ('Account' not in row):
-                    if (not accountForSingleAccountCsv):
-                        investAccountNames = sorted(investAccountsByName.keys())
-                        selection = JOptionPane.showInputDialog(
-                            None,
-                            "Select an investment account:",
-                            "Investment Account Selection Dialog",
-                            JOptionPane.QUESTION_MESSAGE,
-                            None,
-                            investAccountNames,
-                            investAccountNames[0])
-
-                        if selection is None:
-                            continue
-
-                        accountForSingleAccountCsv = investAccountsByName[selection]
-
-                    account = accountForSingleAccountCsv
-                    
-                else:
-                    accountName1 = accountNamePrefix + row['Account']
-                    accountName1 = accountName1.strip().lower()
-                    if (accountName1 in investAccountsByName):
-                        account = investAccountsByName[accountName1]
-                    else:
-                        accountName2 = row['Account'].strip().lower()
-                        if (accountName2 in investAccountsByName):
-                            account = investAccountsByName[accountName2]
-                        else:
-                            accountNumber = row['Account Number'].strip().lower()
-                            if (accountNumber and accountNumber in investAccountsByNumber):
-                                account = investAccountsByNumber[accountNumber]
-                            else:
-                                txt = "ERROR: account: '%s' AND '%s' with number '%s' NOT found" %(accountName1, accountName2, accountNumber)
-                                importantMessages += txt + '\n';
-                                myPrint(txt)
-                                continue
-
-                if (account):
-                    if 'Action' in row:
-                        rowAction = row['Action']
-                    elif 'Transaction Type' in row:
-                        rowAction = row['Transaction Type']
-                    else:
-                        txt = "ERROR: action not found: '%s'" %(row)
-                        importantMessages += txt + '\n';
-                        myPrint(txt)
-                        continue
-
-                    if 'Amount' in row:
-                        rowAmount = row['Amount']
-                    elif 'Amount ($)' in row:
-                        rowAmount = row['Amount ($)']
-                    else:
-                        txt = "ERROR: amount not found: '%s'" %(row)
-                        importantMessages += txt + '\n';
-                        myPrint(txt)
-                        continue
-
-                    if 'Run Date' in row:
-                        date_string = row['Run Date']
-                    elif 'Date' in row:
-                        date_string = row['Date']
-                    else:
-                        txt = "ERROR: date not found: '%s'" %(row)
-                        importantMessages += txt + '\n';
-                        myPrint(txt)
-                        continue
-
-                    try:
-                        format_string = "%m/%d/%Y"
-                        dateDate = datetime.strptime(date_string, format_string).date()
-                    except ValueError:
-                        format_string = "%m/%d/%y"
-                        dateDate = datetime.strptime(date_string, format_string).date()
-
-                    dateString = dateDate.strftime('%Y%m%d')
-                    date = int(dateString)
-
-                    desc = rowAction
-                    memo = rowAction
-                    niceCheckNum = ""
-
-                    pTxn = ParentTxn.makeParentTxn(
-                        book,
-                        date,
-                        date,
-                        uniqueTime(),
-                        niceCheckNum,
-                        account,
-                        desc,
-                        memo,
-                        -1L,
-                        AbstractTxn.ClearedStatus.UNRECONCILED.legacyValue())                                           # noqa
-
-                    fields = InvestFields()
-                    action = rowAction
-                    if any(substring in action for substring in buyStrings):
-                        txnType = InvestTxnType.BUY
-                    elif any(substring in action for substring in buyXferStrings):
-                        txnType = InvestTxnType.BUY_XFER
-                    elif any(substring in action for substring in sellStrings):
-                        txnType = InvestTxnType.SELL
-                    elif any(substring in action for substring in sellXferStrings):
-                        txnType = InvestTxnType.SELL_XFER
-                    elif any(substring in action for substring in divStrings):
-                        txnType = InvestTxnType.DIVIDEND
-                    elif any(substring in action for substring in divReinvestStrings):
-                        txnType = InvestTxnType.DIVIDEND_REINVEST
-                    elif any(substring in action for substring in incStrings):
-                        txnType = InvestTxnType.MISCINC
-                    elif any(substring in action for substring in miscExpStrings):
-                        txnType = InvestTxnType.MISCEXP
-                    else:
-                        symbol = row['Symbol'].strip()
-                        if (symbol):
-                            txt = "ERROR: unknown action: '%s' . Will record as Xfr" %(action)
-                            importantMessages += txt + '\n';
-                            myPrint(txt)
-                        txnType = InvestTxnType.BANK
-
-                    if (txnType in [InvestTxnType.BUY, InvestTxnType.SELL, InvestTxnType.DIVIDEND, InvestTxnType.BUY_XFER, InvestTxnType.SELL_XFER, InvestTxnType.MISCINC, InvestTxnType.DIVIDEND_REINVEST, InvestTxnType.MISCEXP]):
-                        if 'Description' in row:
-                            csvDescription = row['Description']
-                        elif 'Transaction Type' in row:
-                            csvDescription = row['Investment']
-                        else:
-                            txt = "ERROR: description not found: '%s'" %(row)
-                            importantMessages += txt + '\n';
-                            myPrint(txt)
-                            continue
-
-                        if 'Symbol' in row:
-                            symbol = row['Symbol']
-                        else:
-                            symbol = '' # not present in retirement account CSV files 
-
-                        securityAccount = getSecurityAcct(account, csvDescription, symbol)
-                        if (not securityAccount):
-                            txt = "ERROR: security account: '%s' '%s' NOT found when processing invest account '%s.' Please manually create security and/or add it to the invest account. Will process as Xfr" %(csvDescription, symbol, account.getAccountName())
-                            importantMessages += txt + '\n';
-                            myPrint(txt)
-                            txnType = InvestTxnType.BANK
-                        else:
-                            security = securityAccount.getCurrencyType()
-                            if (not security):
-                                txt = "ERROR: security: '%s' '%s' NOT found. Will process as Xfr" %(csvDescription, symbol)
-                                importantMessages += txt + '\n';
-                                myPrint(txt)
-                                txnType = InvestTxnType.BANK
-                            else:
-                                fields.setFieldStatus(txnType, pTxn)
-                                fields.security = securityAccount
-                                fields.amount = fields.curr.getLongValue(abs(parseAmount(rowAmount)))
-
-                                if (txnType == InvestTxnType.DIVIDEND or txnType == InvestTxnType.MISCINC or txnType == InvestTxnType.MISCEXP):
-                                    fields.shares = 0
-                                    fields.price = 1
-                                else:
-                                    totalAmount = abs(parseAmount(rowAmount))
-
-                                    if 'Quantity' in row:
-                                        rowQuantity = row['Quantity']
-                                    elif 'Shares/Unit' in row:
-                                        rowQuantity = row['Shares/Unit']
-                                    else:
-                                        txt = "ERROR: quantity not found: '%s'" %(row)
-                                        importantMessages += txt + '\n';
-                                        myPrint(txt)
-                                        continue
-
-                                    shares = abs(parseAmount(rowQuantity))
-                                    price = 1.0 if (totalAmount == 0.0 or shares == 0.0) else totalAmount/shares
-
-                                    fields.shares = securityAccount.getCurrencyType().getLongValue(shares)
-                                    fields.price = price
-
-                    if (txnType == InvestTxnType.BANK):
-                        fields.setFieldStatus(txnType, pTxn)
-			fields.amount = fields.curr.getLongValue(parseAmount(rowAmount))
-
-                    fields.date = date
-                    fields.taxDate = date
-                    fields.checkNum = niceCheckNum
-                    fields.payee = desc
-                    fields.memo = memo
-
-                    fields.xfrAcct = AccountUtil.getDefaultTransferAcct(account)
-                    fields.fee = 0
-                    if MD_REF.getBuild() >= 5202:
-                        fields.feeAcct = AccountUtil.getDefaultFeeCategoryForAcct(account)                              # noqa
-                    else:
-                        fields.feeAcct = AccountUtil.getDefaultCategoryForAcct(account)
-                    fields.category = AccountUtil.getDefaultCategoryForAcct(account)
-                    fields.storeFields(pTxn)
-                    pTxn.setIsNew(1)
-                    if (online):
-                        pTxn.setFIID(FIID)
-                        pTxn.setFiTxnId(protocolId, txnKey(row)) 
-                        pTxn.setParameter("ol.orig-payee", desc)
-                        pTxn.setParameter("ol.orig-memo", memo)
-                    pTxn.syncItem()
-                    countCreated += 1
-                    if (debug): myPrint("stored fields %s as txn %s" %(fields, pTxn))
-
-        if (countDuplicates):
-            msg = "Created %s transactions\nIgnored %s duplicate transactions" %(countCreated, countDuplicates)
+        if (options.undoBatch):
+            msg = undoImport(book, ui, options.undoBatch, options)
         else:
-            msg = "Created %s transactions" %(countCreated)
-        if (importantMessages):
-            msg += '\n\n' + importantMessages + ' '; # + ' ' needed to not skip last word of message
-        myPrint(msg)
-        mdGUI.showInfoMessage(msg)
+            msg = runImport(book, ui, csvFileNames, options, ImportProgress())
+        ui.showInfo(msg)
 
     except QuickAbortThisScriptException: pass
     except:
@@ -507,9 +2509,10 @@ def doMain():
         txt = "Error detected whilst running script: '%s'" %(exc_value)
         myPrint(txt)
         dump()
-        mdGUI.showErrorMessage(txt + " (review console)")
+        ui.showError(txt + " (review console)")
 
     finally:
+        if (claimed): releaseImportRun()
         # nuke moneydance references that can prevent garbage collection...
         del mdGUI
         del book
@@ -519,4 +2522,6 @@ def doMain():
         del MD_REF
 
 
-SwingUtilities.invokeLater(doMain)
+# tools/headless_import.py loads this script outside Moneydance with moneydance_script_fixed_parameter = "headless"
+if globals().get("moneydance_script_fixed_parameter") != "headless":
+    threading.Thread(target=doMain, name="import_fidelity_worker").start()
@@ -0,0 +1,76 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Regression check: txns imported by the script before the txnKey() digests - their fiTxnId the json (protocol 100)
+# or python repr (protocol 99) of the csv.DictReader row - must be found again when the same csv is re-imported.
+# Each case builds an in-memory book (tools/mdfake.py) keyed the old way, re-imports the csv and expects every row
+# to be ignored as a duplicate. Python 2.7 or Jython 2.7:
+#
+#   python2 tools/check_legacy_ids.py
+#
+# Exits 1 if any case creates txns.
+
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mdfake                                                                                                   # noqa
+
+ACCOUNT_NAME = "Fidelity 401K"
+HEADER = "Date,Investment,Transaction Type,Amount,Shares/Unit"
+ROWS = ["01/02/2024,FID CONTRAFUND,Contributions,100,1.5",
+        "01/03/2024,FID CONTRAFUND,Contributions,200,3.0",
+        "01/03/2024,FID CONTRAFUND,Contributions,200,3.0",
+        "01/04/2024,FID CONTRAFUND,FEE CHARGED,-5,0.000"]
+
+# (name, csv text) - the trailing comma on the rows but not the header gave DictReader a None key of surplus fields
+CASES = [("matching columns", "\n".join([HEADER] + ROWS) + "\n"),
+         ("surplus trailing field", "\n".join([HEADER] + [row + "," for row in ROWS]) + "\n")]
+
+def legacyIds(csvPath):
+    # the fiTxnIds the original script stored: the DictReader row, with a 'Unique' tie-breaker on repeated rows
+    with open(csvPath, 'rb') as csvFile:
+        reader = csv.reader(csvFile)
+        header = next(reader)
+        seen = set()
+        for unique, row in enumerate(csv.DictReader(csvFile, fieldnames=header)):
+            if (json.dumps(row, sort_keys=True) in seen): row['Unique'] = str(1700000000000 + unique)
+            seen.add(json.dumps(row, sort_keys=True))
+            yield row
+
+def runCase(script, protocolId, csvPath):
+    book = mdfake.FakeBook()
+    account = book.addInvestAccount(ACCOUNT_NAME, "", [("FID CONTRAFUND", "")])
+    script.MD_REF.book = book
+    for row in legacyIds(csvPath):
+        fiTxnId = json.dumps(row, sort_keys=True, separators=(',', ':')) if (protocolId == script.JSON_PROTOCOL_ID) else repr(row)
+        txn = script.ParentTxn.makeParentTxn(book, 20240102, 20240102, 0, "", account, "x", "x", -1, None)
+        txn.setFIID(script.FIID)
+        txn.setFiTxnId(protocolId, fiTxnId)
+        txn.syncItem()
+    _summary, progress = script.runHeadless([csvPath], defaultAccountName=ACCOUNT_NAME, confirmPlan=0)
+    return progress.countCreated, progress.countDuplicates
+
+def main():
+    script = mdfake.loadScript(mdfake.FakeMoneydance(mdfake.FakeBook()))
+    directory = tempfile.mkdtemp(prefix="check_legacy_ids_")
+    failures = 0
+    try:
+        for name, text in CASES:
+            csvPath = os.path.join(directory, "history.csv")
+            with open(csvPath, 'wb') as csvFile: csvFile.write(text)
+            for protocolId in [script.JSON_PROTOCOL_ID, script.OLD_PROTOCOL_ID]:
+                created, duplicates = runCase(script, protocolId, csvPath)
+                ok = (created == 0 and duplicates == len(ROWS))
+                if (not ok): failures += 1
+                print("%-4s %-24s protocol %s: created %s, duplicates %s" %("ok" if ok else "FAIL", name, protocolId, created, duplicates))
+    finally:
+        shutil.rmtree(directory)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
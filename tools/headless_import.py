@@ -0,0 +1,83 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Runs import_fidelity.py's import engine outside Moneydance, into an in-memory book (tools/mdfake.py) - for
+# scripted runs, trying out a csv before importing it for real, and benchmarks. Python 2.7 or Jython 2.7:
+#
+#   python2 tools/headless_import.py --account "Fidelity Brokerage=X12345678" \
+#                                    --security "Fidelity Brokerage=APPLE INC=AAPL" history.csv
+#
+# Each csv is imported into the book once per --repeat (the repeats show the duplicate detection at work). With --plan
+# nothing is imported: the plan is listed instead, one line per row. --undo then undoes an import batch ("last", or a
+# batch id from the run's output) - e.g. --repeat 2 --undo last shows the txns of the last run deleted again.
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mdfake                                                                                                   # noqa
+
+def parseOption(value):
+    name, _equals, text = value.partition("=")
+    try:
+        return name.strip(), int(text)
+    except ValueError:
+        return name.strip(), text
+
+def makeBook(accounts, securities):
+    # accounts: ["name[=number]"], securities: ["account name=security name=ticker"]
+    book = mdfake.FakeBook()
+    investAccounts = {}
+    for account in accounts:
+        name, _equals, number = account.partition("=")
+        investAccounts[name.strip()] = book.addInvestAccount(name.strip(), number.strip())
+    for security in securities:
+        parts = [part.strip() for part in security.split("=")]
+        if (len(parts) != 3 or parts[0] not in investAccounts):
+            raise ValueError("--security '%s' is not 'account name=security name=ticker' for a given --account" %(security))
+        book.addSecurity(investAccounts[parts[0]], parts[1], parts[2])
+    return book
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] csvfile...")
+    parser.add_option("--account", action="append", default=[], help="investment account 'name[=number]' (repeatable)")
+    parser.add_option("--security", action="append", default=[], help="security 'account name=security name=ticker' (repeatable)")
+    parser.add_option("--default-account", help="account for csv files without an account column")
+    parser.add_option("--option", action="append", default=[], help="import option 'name=value' e.g. forceFullCheck=1 (repeatable)")
+    parser.add_option("--repeat", type="int", default=1, help="import the files this many times")
+    parser.add_option("--plan", action="store_true", default=False, help="dry run - list what would be imported, row by row")
+    parser.add_option("--undo", action="append", default=[], metavar="BATCH", help="after importing, undo import batch BATCH ('last' or a batch id) (repeatable)")
+    options, csvFileNames = parser.parse_args(argv[1:])
+    if (not csvFileNames): parser.error("no csv files given")
+
+    book = makeBook(options.account, options.security)
+    script = mdfake.loadScript(mdfake.FakeMoneydance(book))
+    importOptions = dict([parseOption(option) for option in options.option])
+    if (options.plan): importOptions["dryRun"] = 1
+
+    for run in range(options.repeat):
+        start = time.time()
+        try:
+            summary, progress = script.runHeadless(csvFileNames, defaultAccountName=options.default_account, **importOptions)
+        except script.QuickAbortThisScriptException:
+            print("Import aborted")
+            return 1
+        print("run %s: %.3fs - %s txns in the book" %(run + 1, time.time() - start, book.getTransactionSet().getSize()))
+        if (options.plan):
+            for status, fileName, date, reason, detail in progress.plan.rows():
+                print("%-6s %s %s %s %s" %(status, fileName, date or "", reason, detail))
+
+    for batchRef in options.undo:
+        start = time.time()
+        try:
+            script.runHeadlessUndo(batchRef, **importOptions)
+        except script.QuickAbortThisScriptException:
+            print("Undo of '%s' aborted" %(batchRef))
+            return 1
+        print("undo %s: %.3fs - %s txns in the book" %(batchRef, time.time() - start, book.getTransactionSet().getSize()))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,477 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# In-memory stand-in for the parts of Moneydance (and of the java / swing classes) that import_fidelity.py uses, so
+# that its import engine can run headless - under Python 2.7 or Jython 2.7 - for scripted runs and benchmarks.
+#
+#   md = FakeMoneydance()
+#   brokerage = md.book.addInvestAccount("Fidelity Brokerage", "X12345678")
+#   md.book.addSecurity(brokerage, "APPLE INC", "AAPL")
+#   script = loadScript(md)
+#   summary, progress = script.runHeadless(["history.csv"])
+
+import imp
+import io
+import itertools
+import os
+import sys
+import threading
+import time
+import types
+import uuid
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source", "import_fidelity", "import_fidelity.py")
+
+class _Named(object):
+    # an enum constant
+    def __init__(self, name): self.name = name
+    def __repr__(self): return self.name
+    def __str__(self): return self.name
+    def legacyValue(self): return self.name
+
+def _enum(className, names):
+    return type(className, (object,), dict([(name, _Named(name)) for name in names]))
+
+#####################################################
+# java / swing stand-ins (only installed where the real classes are not available, i.e. not under Jython)
+
+class _JavaIOException(Exception): pass
+
+class _System(object):
+    class err(object):
+        @staticmethod
+        def println(msg): sys.stderr.write("%s\n" %(msg))
+
+    @staticmethod
+    def currentTimeMillis(): return long(time.time() * 1000)
+
+    class _Properties(dict):
+        lock = threading.Lock()
+        def putIfAbsent(self, key, value):
+            with self.lock:
+                if (key in self): return self[key]
+                self[key] = value
+                return None
+
+    properties = _Properties()
+
+    @staticmethod
+    def getProperties(): return _System.properties
+
+    @staticmethod
+    def getProperty(key): return _System.properties.get(key)
+
+    @staticmethod
+    def clearProperty(key): return _System.properties.pop(key, None)
+
+class _File(object):
+    def __init__(self, parent, name=None):
+        self.path = os.path.join(str(parent), name) if (name is not None) else str(parent)
+    def exists(self): return os.path.exists(self.path)
+    def canRead(self): return os.access(self.path, os.R_OK)
+    def isDirectory(self): return os.path.isdir(self.path)
+    def getName(self): return os.path.basename(self.path)
+    def getAbsolutePath(self): return os.path.abspath(self.path)
+    def getParentFile(self): return _File(os.path.dirname(self.path))
+    def listFiles(self, filenameFilter):
+        return [_File(self.path, name) for name in sorted(os.listdir(self.path)) if filenameFilter.accept(self, name)]
+    def __str__(self): return self.path
+
+def _interface(name):
+    # a java interface - every one is its own class (the script's classes implement several)
+    return type(name, (object,), {})
+
+class _FileUtil(object):
+    @staticmethod
+    def wrap(stream): return stream
+
+class _Unavailable(object):
+    # the Swing UI is never shown headless
+    def __init__(self, *args, **kwargs): raise NotImplementedError("Swing is not available headless")
+
+class _DateUtil(object):
+    lock = threading.Lock()
+    last = [0]
+
+    @staticmethod
+    def getUniqueCurrentTimeMillis():
+        with _DateUtil.lock:
+            now = max(long(time.time() * 1000), _DateUtil.last[0] + 1)
+            _DateUtil.last[0] = now
+            return now
+
+#####################################################
+# Moneydance model stand-ins
+
+InvestTxnType = _enum("InvestTxnType", ["BUY", "SELL", "BUY_XFER", "SELL_XFER", "DIVIDEND", "DIVIDEND_REINVEST",
+                                        "DIVIDENDXFR", "SHORT", "COVER", "MISCINC", "MISCEXP", "BANK"])
+
+class AbstractTxn(object):
+    ClearedStatus = _enum("ClearedStatus", ["UNRECONCILED", "CLEARED", "RECONCILING"])
+
+class AcctFilter(object):
+    ALL_ACCOUNTS_FILTER = _Named("ALL_ACCOUNTS_FILTER")
+
+TxnSearch = _interface("TxnSearch")
+AccountListener = _interface("AccountListener")
+CurrencyListener = _interface("CurrencyListener")
+
+class UserPreferences(object):
+    IMPORT_DIR = "import_dir"
+    DATA_DIR = "data_dir"
+
+class CurrencyType(object):
+    Type = _enum("Type", ["CURRENCY", "SECURITY"])
+
+    def __init__(self, currencyTable=None):
+        self.currencyTable = currencyTable
+        self.name = None
+        self.tickerSymbol = ''
+        self.idString = None
+        self.currencyType = CurrencyType.Type.CURRENCY
+        self.decimalPlaces = 2
+        self.relativeRate = 1.0
+
+    @staticmethod
+    def make(name, tickerSymbol, decimalPlaces=2, currencyType=None):
+        currency = CurrencyType()
+        currency.name = name
+        currency.tickerSymbol = tickerSymbol
+        currency.idString = tickerSymbol
+        currency.decimalPlaces = decimalPlaces
+        currency.currencyType = currencyType or CurrencyType.Type.CURRENCY
+        return currency
+
+    def getName(self): return self.name
+    def getTickerSymbol(self): return self.tickerSymbol
+    def getCurrencyType(self): return self.currencyType
+    def getLongValue(self, value): return long(round(value * (10 ** self.decimalPlaces)))
+    def setEditingMode(self): pass
+    def setName(self, name): self.name = name
+    def setTickerSymbol(self, tickerSymbol): self.tickerSymbol = tickerSymbol
+    def setIDString(self, idString): self.idString = idString
+    def setCurrencyType(self, currencyType): self.currencyType = currencyType
+    def setDecimalPlaces(self, decimalPlaces): self.decimalPlaces = decimalPlaces
+    def setRelativeRate(self, relativeRate): self.relativeRate = relativeRate
+    def syncItem(self):
+        if (self not in self.currencyTable.currencies): self.currencyTable.add(self)
+
+class Account(object):
+    AccountType = _enum("AccountType", ["ROOT", "BANK", "INVESTMENT", "SECURITY", "EXPENSE", "INCOME"])
+
+    def __init__(self, book, name, accountType, parent=None, currency=None, investAccountNumber=''):
+        self.book = book
+        self.uuid = str(uuid.uuid4())
+        self.name = name
+        self.accountType = accountType
+        self.parent = parent
+        self.currency = currency
+        self.investAccountNumber = investAccountNumber
+        self.subAccounts = []
+
+    def getUUID(self): return self.uuid
+    def getAccountName(self): return self.name
+    def getAccountType(self): return self.accountType
+    def getParentAccount(self): return self.parent
+    def getSubAccounts(self): return list(self.subAccounts)
+    def getCurrencyType(self): return self.currency
+    def getInvestAccountNumber(self): return self.investAccountNumber
+    def setAccountName(self, name): self.name = name
+    def setCurrencyType(self, currency): self.currency = currency
+    def syncItem(self):
+        if (self not in self.parent.subAccounts): self.book.addAccount(self.parent, self)
+
+    @staticmethod
+    def makeAccount(book, accountType, parent): return Account(book, None, accountType, parent)
+
+    def __repr__(self): return "<Account %s>" %(self.name)
+
+class ParentTxn(object):
+    @staticmethod
+    def makeParentTxn(book, date, taxDate, dateEntered, checkNum, account, description, memo, txnId, status):
+        return ParentTxn(book, date, taxDate, dateEntered, checkNum, account, description, memo, status)
+
+    def __init__(self, book, date, taxDate, dateEntered, checkNum, account, description, memo, status):
+        self.book = book
+        self.uuid = str(uuid.uuid4())
+        self.date = date
+        self.taxDate = taxDate
+        self.dateEntered = dateEntered
+        self.checkNum = checkNum
+        self.account = account
+        self.description = description
+        self.memo = memo
+        self.status = status
+        self.fiid = None
+        self.fiTxnIds = {}
+        self.parameters = {}
+        self.isNew = False
+        self.investFields = None
+
+    def getUUID(self): return self.uuid
+    def getDateInt(self): return self.date
+    def getAccount(self): return self.account
+    def getDescription(self): return self.description
+    def setEditingMode(self): pass
+    def setIsNew(self, isNew): self.isNew = bool(isNew)
+    def setFIID(self, fiid): self.fiid = fiid
+    def getFIID(self): return self.fiid
+    def getFiTxnId(self, protocolId): return self.fiTxnIds.get(protocolId)
+    def setParameter(self, key, value): self.parameters[key] = value
+    def getParameter(self, key, default=None): return self.parameters.get(key, default)
+
+    def setFiTxnId(self, protocolId, fiTxnId):
+        if (fiTxnId is None):
+            self.fiTxnIds.pop(protocolId, None)
+        else:
+            self.fiTxnIds[protocolId] = fiTxnId
+
+    def syncItem(self): self.book.transactionSet.sync(self)
+    def deleteItem(self): self.book.transactionSet.delete(self)
+
+class InvestFields(object):
+    def __init__(self):
+        self.txnType = None
+        self.curr = None
+        self.security = None
+        self.amount = 0
+        self.shares = 0
+        self.price = 1
+        self.date = 0
+        self.taxDate = 0
+        self.checkNum = ""
+        self.payee = ""
+        self.memo = ""
+        self.xfrAcct = None
+        self.fee = 0
+        self.feeAcct = None
+        self.category = None
+
+    def setFieldStatus(self, txnType, pTxn):
+        self.txnType = txnType
+        self.curr = pTxn.getAccount().getCurrencyType()
+
+    def storeFields(self, pTxn):
+        pTxn.investFields = dict(self.__dict__)
+
+class AccountUtil(object):
+    @staticmethod
+    def allMatchesForSearch(book, acctFilter): return book.allAccounts()
+
+    @staticmethod
+    def getDefaultTransferAcct(account): return account.book.category("Transfers", Account.AccountType.BANK)
+
+    @staticmethod
+    def getDefaultCategoryForAcct(account): return account.book.category("Investment Income", Account.AccountType.INCOME)
+
+    @staticmethod
+    def getDefaultFeeCategoryForAcct(account): return account.book.category("Investment Fees", Account.AccountType.EXPENSE)
+
+#####################################################
+# the book
+
+class FakeTxnList(list):
+    def getSize(self): return len(self)
+
+class FakeTransactionSet(object):
+    def __init__(self):
+        self.txns = {}
+        self.byAccount = {}
+        self.countSyncs = 0
+        self.countDeletes = 0
+
+    def sync(self, txn):
+        self.countSyncs += 1
+        if (txn.uuid in self.txns): return
+        self.txns[txn.uuid] = txn
+        self.byAccount.setdefault(txn.account.getUUID(), []).append(txn)
+
+    def delete(self, txn):
+        if (self.txns.pop(txn.uuid, None) is None): return
+        self.countDeletes += 1
+        self.byAccount[txn.account.getUUID()].remove(txn)
+
+    def getTransactionsForAccount(self, account): return FakeTxnList(self.byAccount.get(account.getUUID(), []))
+    def getTxnByID(self, txnID): return self.txns.get(txnID)
+    def iterableTxns(self): return list(self.txns.values())
+    def getSize(self): return len(self.txns)
+
+class _StoredFile(io.BytesIO):
+    def __init__(self, storage, name):
+        io.BytesIO.__init__(self)
+        self.storage = storage
+        self.name = name
+
+    def close(self):
+        if (not self.closed): self.storage.files[self.name] = self.getvalue()
+        io.BytesIO.close(self)
+
+class FakeLocalStorage(object):
+    def __init__(self):
+        self.files = {}
+
+    def openFileForReading(self, name):
+        if (name not in self.files): raise _ioException()("%s not found" %(name))
+        return io.BytesIO(self.files[name])
+
+    def openFileForWriting(self, name): return _StoredFile(self, name)
+
+class FakeCurrencyTable(object):
+    def __init__(self):
+        self.listeners = []
+        self.currencies = []
+
+    def getAllCurrencies(self): return list(self.currencies)
+    def addCurrencyListener(self, listener): self.listeners.append(listener)
+    def removeCurrencyListener(self, listener): self.listeners.remove(listener)
+
+    def add(self, currency):
+        self.currencies.append(currency)
+        for listener in list(self.listeners): listener.currencyTableModified(self)
+
+class FakeBook(object):
+    def __init__(self):
+        self.root = Account(self, "Root", Account.AccountType.ROOT)
+        self.dollars = CurrencyType.make("US Dollar", "USD", 2)
+        self.transactionSet = FakeTransactionSet()
+        self.localStorage = FakeLocalStorage()
+        self.currencies = FakeCurrencyTable()
+        self.accountListeners = []
+        self.categories = {}
+        self.recalcBalances = True
+
+    def getRootAccount(self): return self.root
+    def getTransactionSet(self): return self.transactionSet
+    def getLocalStorage(self): return self.localStorage
+    def getCurrencies(self): return self.currencies
+    def setRecalcBalances(self, recalc): self.recalcBalances = recalc
+    def addAccountListener(self, listener): self.accountListeners.append(listener)
+    def removeAccountListener(self, listener): self.accountListeners.remove(listener)
+
+    def allAccounts(self):
+        accounts = []
+        pending = [self.root]
+        while (pending):
+            account = pending.pop(0)
+            accounts.append(account)
+            pending.extend(account.subAccounts)
+        return accounts
+
+    def addAccount(self, parent, account):
+        parent.subAccounts.append(account)
+        for listener in list(self.accountListeners): listener.accountAdded(parent, account)
+        return account
+
+    def category(self, name, accountType):
+        if (name not in self.categories):
+            self.categories[name] = self.addAccount(self.root, Account(self, name, accountType, self.root, self.dollars))
+        return self.categories[name]
+
+    def addInvestAccount(self, name, investAccountNumber='', securities=()):
+        # securities: [(name, ticker)]
+        investAcct = self.addAccount(self.root, Account(self, name, Account.AccountType.INVESTMENT, self.root, self.dollars,
+                                                        investAccountNumber))
+        for securityName, ticker in securities: self.addSecurity(investAcct, securityName, ticker)
+        return investAcct
+
+    def addSecurity(self, investAcct, name, ticker, decimalPlaces=4):
+        security = CurrencyType.make(name, ticker, decimalPlaces, CurrencyType.Type.SECURITY)
+        self.currencies.add(security)
+        return self.addAccount(investAcct, Account(self, name, Account.AccountType.SECURITY, investAcct, security))
+
+class FakeStrings(object):
+    choose_import_file = "Choose import file"
+    unable_to_read_file = "Unable to read file"
+
+class FakeGUI(object):
+    def __init__(self):
+        self.suspendRefresh = False
+        self.messages = []
+
+    def getStrings(self): return FakeStrings()
+    def setSuspendRefresh(self, suspend): self.suspendRefresh = suspend
+    def showInfoMessage(self, msg): self.messages.append(msg)
+    def showErrorMessage(self, msg): self.messages.append(msg)
+
+class FakePreferences(object):
+    def __init__(self): self.settings = {}
+    def setSetting(self, key, value): self.settings[key] = value
+    def getSetting(self, key, default=None): return self.settings.get(key, default)
+
+class FakeMoneydance(object):
+    def __init__(self, book=None, build=5300):
+        self.book = book or FakeBook()
+        self.build = build
+        self.ui = FakeGUI()
+        self.preferences = FakePreferences()
+
+    def getBuild(self): return self.build
+    def getCurrentAccountBook(self): return self.book
+    def getCurrentAccount(self): return self.book.getRootAccount()
+    def getUI(self): return self.ui
+    def getPreferences(self): return self.preferences
+
+#####################################################
+# loading the script
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+def _javaModules():
+    return [_module("java"),
+            _module("java.lang", System=_System),
+            _module("java.awt", FileDialog=_enum("FileDialog", ["LOAD", "SAVE"]), BorderLayout=_Unavailable),
+            _module("java.io", File=_File, FilenameFilter=_interface("FilenameFilter"), IOException=_JavaIOException),
+            _module("javax"),
+            _module("javax.swing", SwingUtilities=_Unavailable, JOptionPane=_Unavailable, JDialog=_Unavailable,
+                    JLabel=_Unavailable, JButton=_Unavailable, JPanel=_Unavailable, Timer=_Unavailable),
+            _module("javax.swing.border", EmptyBorder=_Unavailable),
+            _module("javax.swing.filechooser", FileFilter=_interface("FileFilter")),
+            _module("org"),
+            _module("org.python"),
+            _module("org.python.core"),
+            _module("org.python.core.util", FileUtil=_FileUtil)]
+
+def _moneydanceModules():
+    return [_module("com"),
+            _module("com.infinitekind"),
+            _module("com.infinitekind.moneydance"),
+            _module("com.infinitekind.moneydance.model", ParentTxn=ParentTxn, AbstractTxn=AbstractTxn,
+                    InvestTxnType=InvestTxnType, InvestFields=InvestFields, AccountUtil=AccountUtil, TxnSearch=TxnSearch,
+                    Account=Account, AcctFilter=AcctFilter, AccountListener=AccountListener,
+                    CurrencyListener=CurrencyListener, CurrencyType=CurrencyType),
+            _module("com.infinitekind.util", DateUtil=_DateUtil, AppDebug=_Unavailable),
+            _module("com.moneydance"),
+            _module("com.moneydance.apps"),
+            _module("com.moneydance.apps.md"),
+            _module("com.moneydance.apps.md.controller", UserPreferences=UserPreferences)]
+
+def _register(modules):
+    for module in modules:
+        sys.modules[module.__name__] = module
+        parentName, _dot, childName = module.__name__.rpartition(".")
+        if (parentName): setattr(sys.modules[parentName], childName, module)
+
+def _ioException():
+    return sys.modules["java.io"].IOException
+
+def install():
+    # The Moneydance model is always the fake one. The java / swing classes are the real ones under Jython
+    try:
+        import java.io                                                                                          # noqa
+    except ImportError:
+        _register(_javaModules())
+    _register(_moneydanceModules())
+
+def loadScript(moneydance, scriptPath=SCRIPT):
+    # Loads import_fidelity.py as Moneydance would, bound to moneydance (a FakeMoneydance) - but without starting the
+    # Swing import. Returns the script as a module (runHeadless(), runImport() ...)
+    install()
+    module = imp.new_module("import_fidelity")
+    module.__dict__.update(moneydance=moneydance, moneydance_script_fixed_parameter="headless")
+    with open(scriptPath) as scriptFile:
+        source = scriptFile.read()
+    exec(compile(source, scriptPath, "exec"), module.__dict__)
+    return module